@@ -0,0 +1,133 @@
+"""
+Times each stage of the moving rates pipeline against synthetic referral data of increasing size and writes the
+results to a JSON file, so that the timings of one release can be compared with another.
+
+usage: python benchmarks.py [--sizes 10000,100000,1000000,10000000] [--clinics 50] [--repeat 3]
+                            [--data-dir bench_data] [--output benchmark_results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+
+import numpy as np
+
+import pandas as pd
+
+import bokeh
+
+from datetime import datetime
+
+from referral_data import (COLUMN_TYPES, DATE_COLUMNS, load_data, process_record_transforms,
+                           calculate_window_measures, calculate_rolling_measures, calculate_trend_fits)
+from clinic_plots import DailyVolumesPlot, MovingVolumesPlot, MovingRatesPlot
+from pipeline_metrics import get_peak_rss_kb
+from synthetic_referrals import write_synthetic_referrals
+
+
+SIZES = [10000, 100000, 1000000, 10000000]
+
+
+def time_stage(func, repeat: int) -> dict:
+    """Calls the given function repeatedly and returns the timings in seconds along with its last result."""
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return {'min_seconds': min(seconds),
+            'median_seconds': statistics.median(seconds),
+            'runs': seconds,
+            'result': result}
+# END time_stage
+
+
+def get_data_file(data_dir: str, num_referrals: int, num_clinics: int) -> str:
+    """Returns the path of a synthetic referral file of the given size, creating the file if it does not exist."""
+    file_path = os.path.join(data_dir, f'referrals_{num_referrals}_{num_clinics}.csv')
+    if not os.path.exists(file_path):
+        os.makedirs(data_dir, exist_ok=True)
+        print(f'creating {file_path}...')
+        write_synthetic_referrals(file_path, num_referrals=num_referrals, num_clinics=num_clinics)
+    return file_path
+# END get_data_file
+
+
+def benchmark_size(file_path: str, repeat: int) -> dict:
+    """Returns the timings of each pipeline stage run against the given file of referral data."""
+    stages = {}
+
+    def record(name: str, func):
+        print(f'  {name}...')
+        timing = time_stage(func, repeat)
+        stages[name] = {k: v for k, v in timing.items() if k != 'result'}
+        return timing['result']
+
+    referral_df = record('load_data', lambda: load_data(file_path, COLUMN_TYPES, DATE_COLUMNS))
+    record('process_record_transforms', lambda: process_record_transforms(referral_df))
+    rolling_df, start_dt, end_dt = record('calculate_rolling_measures',
+                                          lambda: calculate_rolling_measures(referral_df))
+
+    # A single window is timed against the daily counts without any moving measures
+    daily_df = rolling_df[['Date', 'Clinic', '# Aged', '# Seen in 30d']]
+    record('calculate_window_measures', lambda: calculate_window_measures(daily_df, 91))
+    rolling_df = record('calculate_trend_fits', lambda: calculate_trend_fits(rolling_df.copy()))
+
+    # Each plot dataset is timed for every clinic and for one typical clinic
+    clinic = rolling_df.loc[rolling_df['Clinic'] != '*ALL*', 'Clinic'].mode().iloc[0]
+    for plot_class in [MovingRatesPlot, MovingVolumesPlot, DailyVolumesPlot]:
+        record(f'{plot_class.__name__}.create_dataset *ALL*',
+               lambda: plot_class.create_dataset(rolling_df, '*ALL*'))
+        record(f'{plot_class.__name__}.create_dataset clinic',
+               lambda: plot_class.create_dataset(rolling_df, clinic))
+
+    return {'referral_rows': len(referral_df),
+            'rolling_rows': len(rolling_df),
+            'clinics': int(rolling_df['Clinic'].nunique()),
+            'peak_rss_kb': get_peak_rss_kb(),
+            'stages': stages}
+# END benchmark_size
+
+
+def run_benchmarks(sizes: list[int], num_clinics: int, repeat: int, data_dir: str) -> dict:
+    """Returns the benchmark results of every size of referral data along with a description of the environment."""
+    results = {'created': datetime.now().isoformat(timespec='seconds'),
+               'environment': {'python': platform.python_version(),
+                               'platform': platform.platform(),
+                               'numpy': np.__version__,
+                               'pandas': pd.__version__,
+                               'bokeh': bokeh.__version__},
+               'repeat': repeat,
+               'sizes': {}}
+    for num_referrals in sizes:
+        file_path = get_data_file(data_dir, num_referrals, num_clinics)
+        print(f'benchmarking {num_referrals} referrals...')
+        results['sizes'][str(num_referrals)] = benchmark_size(file_path, repeat)
+    return results
+# END run_benchmarks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the moving rates pipeline with synthetic referral data.')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                        help='comma separated numbers of referrals to benchmark')
+    parser.add_argument('--clinics', type=int, default=50, help='number of clinics in the synthetic data')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times each stage is run')
+    parser.add_argument('--data-dir', default='bench_data', help='folder for the synthetic referral files')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = run_benchmarks(sizes, args.clinics, args.repeat, args.data_dir)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'wrote benchmark results to {args.output}')
+# END main
+
+
+if __name__ == '__main__':
+    main()
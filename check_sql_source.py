@@ -0,0 +1,85 @@
+"""
+Checks that the SQL source of referral data counts referrals and calculates the snapshot offsets with the same rules
+as the CSV source, so that the rules written in SQL cannot drift from process_record_transforms unnoticed. The check
+writes synthetic referrals, some of them without a clinic, to a temporary folder, copies them into a local SQLite
+database, and compares the results of both sources. It runs entirely offline.
+
+usage: python check_sql_source.py [--referrals 20000] [--clinics 20] [--missing-clinic-share 0.02] [--seed 0]
+"""
+
+import argparse
+import os
+import tempfile
+
+import numpy as np
+
+import pandas as pd
+
+from referral_data import CsvReferralSource, SqlReferralSource, create_referral_source, write_sqlite_database
+from synthetic_referrals import create_synthetic_referrals
+
+
+def _sort_counts(count_df: pd.DataFrame) -> pd.DataFrame:
+    """Returns the daily counts in clinic and date order so that the counts of two sources can be compared."""
+    return count_df.sort_values(['Clinic', 'Date'], na_position='first', ignore_index=True)
+
+
+def _sort_offsets(offsets: tuple[pd.DataFrame, pd.Index, object]) -> pd.DataFrame:
+    """Returns the day offsets with clinic names in place of clinic codes, sorted so that sources can be compared."""
+    offset_df, clinics, first_dt = offsets
+    names = pd.Series(np.append(clinics.to_numpy(dtype=object), None))
+    sorted_df = offset_df.drop(columns='Clinic Code').assign(Clinic=names[offset_df['Clinic Code']].to_numpy())
+    return sorted_df.sort_values(list(sorted_df.columns), na_position='first', ignore_index=True)
+
+
+def compare_sources(csv_path: str, db_path: str) -> None:
+    """Raises an AssertionError when the SQL source of a database disagrees with the CSV source of the same data."""
+    csv_source = create_referral_source(csv_path)
+    sql_source = create_referral_source(db_path)
+    assert isinstance(csv_source, CsvReferralSource) and isinstance(sql_source, SqlReferralSource)
+
+    print('comparing daily counts...')
+    pd.testing.assert_frame_equal(_sort_counts(sql_source.load_daily_counts()),
+                                  _sort_counts(csv_source.load_daily_counts()))
+
+    print('comparing referral offsets...')
+    csv_offsets = csv_source.load_referral_offsets()
+    sql_offsets = sql_source.load_referral_offsets()
+    assert sql_offsets[2] == csv_offsets[2], f'first sent dates differ: {sql_offsets[2]} and {csv_offsets[2]}'
+    assert set(sql_offsets[1]) == set(csv_offsets[1]), 'clinics differ'
+    pd.testing.assert_frame_equal(_sort_offsets(sql_offsets), _sort_offsets(csv_offsets))
+# END compare_sources
+
+
+def run_check(num_referrals: int, num_clinics: int, missing_clinic_share: float, seed: int) -> None:
+    """Writes synthetic referrals to a text file and a SQLite database and compares the two sources of them."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        csv_path = os.path.join(data_dir, 'referrals.csv')
+        db_path = os.path.join(data_dir, 'referrals.db')
+        print(f'creating {num_referrals} synthetic referrals...')
+        df = create_synthetic_referrals(num_referrals=num_referrals, num_clinics=num_clinics, seed=seed)
+        rng = np.random.default_rng(seed)
+        df.loc[rng.random(len(df)) < missing_clinic_share, 'Clinic'] = pd.NA
+        df.to_csv(csv_path, index=False, date_format='%Y-%m-%d')
+        print('writing SQLite database...')
+        write_sqlite_database(csv_path, db_path)
+        compare_sources(csv_path, db_path)
+# END run_check
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Check the SQL source of referral data against the CSV source.')
+    parser.add_argument('--referrals', type=int, default=20000, help='number of synthetic referrals')
+    parser.add_argument('--clinics', type=int, default=20, help='number of synthetic clinics')
+    parser.add_argument('--missing-clinic-share', type=float, default=0.02,
+                        help='share of referrals written without a clinic')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    args = parser.parse_args()
+
+    run_check(args.referrals, args.clinics, args.missing_clinic_share, args.seed)
+    print('the SQL source matches the CSV source')
+# END main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,547 @@
+"""
+Bokeh figures of moving process rates and referral volumes that are filtered by clinic. These classes are used by the
+moving process rates application and by the batch export of static reports.
+"""
+
+import numpy as np
+from numpy.polynomial import Polynomial
+from numpy import ndarray
+
+import pandas as pd
+
+from datetime import datetime
+
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource, GlyphRenderer, Span
+from bokeh.models.ranges import Range1d
+from bokeh.models.formatters import NumeralTickFormatter
+from bokeh.models.tools import HoverTool, CrosshairTool, PanTool, BoxZoomTool, SaveTool, ResetTool
+
+from referral_data import AS_OF_DATE, TREND_MODELS
+
+
+VISIBLE_RANGE_TREND = 'Linear over visible range'
+
+
+def to_epoch_days(dt) -> float:
+    """Returns the days since the epoch for a datetime or for a timestamp in milliseconds as sent by BokehJS."""
+    if isinstance(dt, (int, float)):
+        return dt / 86400000.0
+    return pd.Timestamp(dt).value / 86400000000000.0
+# END to_epoch_days
+
+
+class ClinicPlot:
+    """Base class used to identify plots with static methods to create plot data."""
+    @staticmethod
+    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
+        pass
+
+    def get_source(self) -> ColumnDataSource:
+        pass
+
+    def reset_y_range(self) -> None:
+        pass
+
+
+class DailyVolumesPlot(ClinicPlot):
+    """
+    Pairs a Bokeh figure and a ColumnDataSource that can be updated to change the figure. The figure is the plot of
+    daily referral volumes that make up the denominator of the moving rate that referrals are seen in 30d across
+    different window sizes.
+
+    Methods:
+         create_dataset - Returns a new DataFrame with data for this visual
+         reset_y_range - Reapplies the full y-axis range in the visual
+         set_trend_model - Changes the trend line to the fit of the given trend model
+         get_figure - Returns the Bokeh figure object associated with the plot
+         get_source - Returns the Bokeh ColumnDataSource object associated with the line glyphs
+         get_lines - Returns a list of Bokeh GlyphRenderer objects for the line glyphs
+    """
+
+    @staticmethod
+    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
+        """Returns a new DataFrame with data for the visual extracted from the given DataFrame."""
+        data_df = source_df.loc[(source_df['Clinic'] == clinic),
+                                ['Date',
+                                 '# Aged',
+                                 'Trend Linear',
+                                 'Trend Robust',
+                                 'Trend Seasonal']].copy()
+        data_df['Trend Visible Range'] = data_df['Trend Linear']
+        return data_df
+    # END _create_dataset
+
+    def __init__(self,
+                 rolling_df: pd.DataFrame,
+                 start_dt: datetime,
+                 ct: CrosshairTool,
+                 clinic: str = '*ALL*',
+                 data: dict[str, ndarray] = None) -> None:
+        """
+        Creates an instance of a daily volumes plot for the application document.
+        :param rolling_df: DataFrame containing the precalculated moving rate data
+        :param start_dt: The starting date for the plot x-axis
+        :param ct: A shared crosshair hover tool for all plots in the document
+        :param clinic: The clinic that is initially plotted
+        :param data: Prepared column data of the clinic, used in place of a new dataset from rolling_df
+        """
+
+        if data is None:
+            data = self.create_dataset(rolling_df, clinic)
+        self.cds = ColumnDataSource(data=data)
+
+        referrals_x_range = Range1d(start_dt, AS_OF_DATE)
+
+        ht = HoverTool(
+            tooltips=[
+                ('date', '@Date{%F}'),
+                ('# Aged', '@{# Aged}{#,##0}')],
+
+            formatters={
+                '@Date': 'datetime'},
+
+            line_policy='none',
+            toggleable=False
+        )
+
+        self.ct = ct
+
+        self.plot = figure(title=None,
+                           output_backend='svg',
+                           x_axis_type='datetime',
+                           x_range=referrals_x_range,
+                           toolbar_location='below',
+                           tools=[PanTool(), BoxZoomTool(), SaveTool(), ResetTool()])
+
+        self.plot.yaxis.formatter = NumeralTickFormatter(format='#,##0')
+        self.plot.yaxis.axis_label = "Daily Volume"
+        self.plot.yaxis.axis_label_text_font = "arial"
+        self.plot.yaxis.axis_label_text_font_size = "12pt"
+        self.plot.yaxis.axis_label_text_font_style = "normal"
+        self.plot.yaxis.axis_label_text_color = "#434244"
+        self.plot.yaxis.major_label_text_color = "#434244"
+        self.plot.yaxis.major_label_text_font = "arial"
+        self.plot.yaxis.major_label_text_font_size = "12pt"
+        self.plot.min_border_left = 60
+
+        self.plot.xaxis.major_label_text_font = "arial"
+        self.plot.xaxis.major_label_text_font_size = "10pt"
+        self.plot.xaxis.major_label_text_color = "#434244"
+
+        self.glyphs = [self.plot.circle(x='Date',
+                                        y='# Aged',
+                                        alpha=0.2,
+                                        color='blue',
+                                        source=self.cds),
+                       self.plot.line(x='Date',
+                                      y='Trend Linear',
+                                      line_color='red',
+                                      line_dash='solid',
+                                      line_width=2,
+                                      source=self.cds)]
+
+        self.plot.add_tools(ht)
+        self.plot.add_tools(self.ct)
+
+        # Trend models are fitted ahead of time for every clinic, except the fit to the visible x-axis range
+        self.trend_model = 'Linear'
+    # END __init__
+
+    def _update_visible_range_trend(self, attr, old, new) -> None:
+        """Refits a linear trend to the daily volumes within the visible x-axis range of the plot."""
+        if self.trend_model != VISIBLE_RANGE_TREND:
+            return
+
+        days = self.cds.data['Date'].astype('datetime64[ms]').astype(float) / 86400000.0
+        volumes = np.asarray(self.cds.data['# Aged'], dtype=float)
+        start, end = (to_epoch_days(self.plot.x_range.start), to_epoch_days(self.plot.x_range.end))
+        idx = (days >= start) & (days <= end)
+        if idx.sum() < 2:
+            trend = np.asarray(self.cds.data['Trend Linear'], dtype=float)
+        else:
+            f = Polynomial.fit(days[idx], volumes[idx], 1, full=False)
+            trend = f(days)
+
+        # Stop changes caused by this callback from reflecting as another callback
+        self.cds.remove_on_change('data', self._update_visible_range_trend)
+        self.cds.data['Trend Visible Range'] = trend
+        self.cds.on_change('data', self._update_visible_range_trend)
+    # END _update_visible_range_trend
+
+    def set_trend_model(self, model: str) -> None:
+        """Changes the trend line to the fit of the given trend model."""
+        # Only the fit to the visible x-axis range needs server callbacks, so they are connected just while it is used
+        if model == VISIBLE_RANGE_TREND and self.trend_model != VISIBLE_RANGE_TREND:
+            self.cds.on_change('data', self._update_visible_range_trend)
+            self.plot.x_range.on_change('start', self._update_visible_range_trend)
+            self.plot.x_range.on_change('end', self._update_visible_range_trend)
+        elif model != VISIBLE_RANGE_TREND and self.trend_model == VISIBLE_RANGE_TREND:
+            self.cds.remove_on_change('data', self._update_visible_range_trend)
+            self.plot.x_range.remove_on_change('start', self._update_visible_range_trend)
+            self.plot.x_range.remove_on_change('end', self._update_visible_range_trend)
+
+        self.trend_model = model
+        column = TREND_MODELS.get(model, 'Trend Visible Range')
+        self._update_visible_range_trend('data', None, None)
+        self.glyphs[1].glyph.y = column
+
+    def reset_y_range(self) -> None:
+        if len(self.cds.data['# Aged']) == 0:
+            return
+        max_y = (self.cds.data['# Aged']).max()
+        self.plot.y_range.start = 0
+        self.plot.y_range.end = max_y
+
+    def get_figure(self) -> figure:
+        """Returns the Bokeh figure object associated with the plot"""
+        return self.plot
+
+    def get_source(self) -> ColumnDataSource:
+        """Returns the Bokeh ColumnDataSource object associated with the line glyphs"""
+        return self.cds
+
+    def get_glyphs(self) -> list[GlyphRenderer]:
+        """Returns a list of Bokeh GlyphRenderer objects for the line glyphs"""
+        return self.glyphs
+# END CLASS DailyVolumesPlot
+
+
+class MovingVolumesPlot(ClinicPlot):
+    """
+    Pairs a Bokeh figure and a ColumnDataSource that can be updated to change the figure. The figure is the plot of
+    moving referral volumes that are the denominator of the rate that referrals are seen in 30d across different window
+    sizes.
+
+    Methods:
+         create_dataset - Returns a new DataFrame with data for this visual
+         reset_y_range - Reapplies the full y-axis range in the visual
+         get_figure - Returns the Bokeh figure object associated with the plot
+         get_source - Returns the Bokeh ColumnDataSource object associated with the line glyphs
+         get_lines - Returns a list of Bokeh GlyphRenderer objects for the line glyphs
+    """
+
+    @staticmethod
+    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
+        """Returns a new DataFrame with data for the visual extracted from the given DataFrame."""
+        data_df = source_df.loc[(source_df['Clinic'] == clinic),
+                                ['Date',
+                                 'Moving 28d % Seen in 30d',
+                                 'Moving 91d % Seen in 30d',
+                                 'Moving 182d % Seen in 30d',
+                                 'Moving 364d % Seen in 30d',
+                                 'Moving 28d # Aged',
+                                 'Moving 91d # Aged',
+                                 'Moving 182d # Aged',
+                                 'Moving 364d # Aged']].copy()
+        data_df['28d Tooltip'] = data_df['Moving 28d % Seen in 30d'] * 100.0
+        data_df['91d Tooltip'] = data_df['Moving 91d % Seen in 30d'] * 100.0
+        data_df['182d Tooltip'] = data_df['Moving 182d % Seen in 30d'] * 100.0
+        data_df['364d Tooltip'] = data_df['Moving 364d % Seen in 30d'] * 100.0
+        return data_df
+    # END _create_dataset
+
+    def __init__(self,
+                 rolling_df: pd.DataFrame,
+                 start_dt: datetime,
+                 ct: CrosshairTool,
+                 clinic: str = '*ALL*',
+                 data: dict[str, ndarray] = None) -> None:
+        """
+        Creates an instance of a moving volumes plot for the application document.
+        :param rolling_df: DataFrame containing the precalculated moving rate data
+        :param start_dt: The starting date for the plot x-axis
+        :param ct: A shared crosshair hover tool for all plots in the document
+        :param clinic: The clinic that is initially plotted
+        :param data: Prepared column data of the clinic, used in place of a new dataset from rolling_df
+        """
+
+        if data is None:
+            data = self.create_dataset(rolling_df, clinic)
+        self.cds = ColumnDataSource(data=data)
+
+        referrals_x_range = Range1d(start_dt, AS_OF_DATE)
+
+        ht = HoverTool(
+            tooltips=[
+                ('date', '@Date{%F}'),
+                ('28d', '@{28d Tooltip}{%0.1f}% over @{Moving 28d # Aged}{#,##0}'),
+                ('91d', '@{91d Tooltip}{%0.1f}% over @{Moving 91d # Aged}{#,##0}'),
+                ('182d', '@{182d Tooltip}{%0.1f}% over @{Moving 182d # Aged}{#,##0}'),
+                ('364d', '@{364d Tooltip}{%0.1f}% over @{Moving 364d # Aged}{#,##0}')
+            ],
+
+            formatters={
+                '@Date': 'datetime',
+                '@{28d Tooltip}': 'printf',
+                '@{91d Tooltip}': 'printf',
+                '@{182d Tooltip}': 'printf',
+                '@{364d Tooltip}': 'printf'
+            },
+
+            mode='vline',
+            line_policy='none',
+            toggleable=False
+        )
+
+        self.ct = ct
+
+        self.plot = figure(title=None,
+                           output_backend='svg',
+                           x_axis_type='datetime',
+                           x_range=referrals_x_range,
+                           toolbar_location='below',
+                           tools=[PanTool(), BoxZoomTool(), SaveTool(), ResetTool()])
+
+        self.plot.yaxis.formatter = NumeralTickFormatter(format='#,##0')
+        self.plot.yaxis.axis_label = "Moving Volume"
+        self.plot.yaxis.axis_label_text_font = "arial"
+        self.plot.yaxis.axis_label_text_font_size = "12pt"
+        self.plot.yaxis.axis_label_text_font_style = "normal"
+        self.plot.yaxis.axis_label_text_color = "#434244"
+        self.plot.yaxis.major_label_text_color = "#434244"
+        self.plot.yaxis.major_label_text_font = "arial"
+        self.plot.yaxis.major_label_text_font_size = "12pt"
+        self.plot.min_border_left = 60
+
+        self.plot.xaxis.major_label_text_font = "arial"
+        self.plot.xaxis.major_label_text_font_size = "10pt"
+        self.plot.xaxis.major_label_text_color = "#434244"
+
+        self.lines = [self.plot.line(x='Date',
+                                     y='Moving 28d # Aged',
+                                     line_width=2,
+                                     line_dash='dotted',
+                                     line_color='gray',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     source=self.cds),
+                      self.plot.line(x='Date',
+                                     y='Moving 91d # Aged',
+                                     line_width=2,
+                                     line_dash='dashed',
+                                     line_color='red',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     source=self.cds),
+                      self.plot.line(x='Date',
+                                     y='Moving 182d # Aged',
+                                     line_width=2,
+                                     line_dash='solid',
+                                     line_color='blue',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     source=self.cds),
+                      self.plot.line(x='Date',
+                                     y='Moving 364d # Aged',
+                                     line_width=2,
+                                     line_dash='solid',
+                                     line_color='black',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     source=self.cds)]
+
+        self.plot.add_tools(ht)
+        self.plot.add_tools(self.ct)
+    # END __init__
+
+    def reset_y_range(self) -> None:
+        if len(self.cds.data['Moving 28d # Aged']) == 0:
+            return
+        max_28d = (self.cds.data['Moving 28d # Aged']).max()
+        max_91d = (self.cds.data['Moving 91d # Aged']).max()
+        max_182d = (self.cds.data['Moving 182d # Aged']).max()
+        max_364d = (self.cds.data['Moving 364d # Aged']).max()
+        max_y = max(max_28d, max_91d, max_182d, max_364d)
+        self.plot.y_range.start = 0
+        self.plot.y_range.end = max_y
+
+    def get_figure(self) -> figure:
+        """Returns the Bokeh figure object associated with the plot"""
+        return self.plot
+
+    def get_source(self) -> ColumnDataSource:
+        """Returns the Bokeh ColumnDataSource object associated with the line glyphs"""
+        return self.cds
+
+    def get_lines(self) -> list[GlyphRenderer]:
+        """Returns a list of Bokeh GlyphRenderer objects for the line glyphs"""
+        return self.lines
+    # END CLASS MovingVolumesPlot
+
+
+class MovingRatesPlot(ClinicPlot):
+    """
+    Pairs a Bokeh figure and a ColumnDataSource that can be updated to change the figure. The figure is the plot of
+    moving rates that referrals are seen in 30d across different window sizes.
+
+    Methods:
+         create_dataset - Returns a new DataFrame with data for this visual
+         reset_y_range - Reapplies the full y-axis range in the visual
+         get_figure - Returns the Bokeh figure object associated with the plot
+         get_source - Returns the Bokeh ColumnDataSource object associated with the line glyphs
+         get_lines - Returns a list of Bokeh GlyphRenderer objects for the line glyphs
+    """
+
+    @staticmethod
+    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
+        """Returns a new DataFrame with data for the visual extracted from the given DataFrame."""
+        data_df = source_df.loc[(source_df['Clinic'] == clinic),
+                                ['Date',
+                                 'Moving 28d % Seen in 30d',
+                                 'Moving 91d % Seen in 30d',
+                                 'Moving 182d % Seen in 30d',
+                                 'Moving 364d % Seen in 30d',
+                                 'Moving 28d # Aged',
+                                 'Moving 91d # Aged',
+                                 'Moving 182d # Aged',
+                                 'Moving 364d # Aged']].copy()
+        data_df['28d Tooltip'] = data_df['Moving 28d % Seen in 30d'] * 100.0
+        data_df['91d Tooltip'] = data_df['Moving 91d % Seen in 30d'] * 100.0
+        data_df['182d Tooltip'] = data_df['Moving 182d % Seen in 30d'] * 100.0
+        data_df['364d Tooltip'] = data_df['Moving 364d % Seen in 30d'] * 100.0
+        return data_df
+    # END _create_dataset
+
+    def __init__(self,
+                 rolling_df: pd.DataFrame,
+                 start_dt: datetime,
+                 ct: CrosshairTool,
+                 clinic: str = '*ALL*',
+                 data: dict[str, ndarray] = None) -> None:
+        """
+        Creates an instance of a moving rates plot for the application document.
+        :param rolling_df: DataFrame containing the precalculated moving rate data
+        :param start_dt: The starting date for the plot x-axis
+        :param ct: A shared crosshair hover tool for all plots in the document
+        :param clinic: The clinic that is initially plotted
+        :param data: Prepared column data of the clinic, used in place of a new dataset from rolling_df
+        """
+        if data is None:
+            data = self.create_dataset(rolling_df, clinic)
+        self.cds = ColumnDataSource(data=data)
+
+        referrals_x_range = Range1d(start_dt, AS_OF_DATE)
+        referrals_y_range = Range1d(0.0, 1.0)
+
+        ht = HoverTool(
+            tooltips=[
+                ('date', '@Date{%F}'),
+                ('28d', '@{28d Tooltip}{%0.1f}% over @{Moving 28d # Aged}{#,##0}'),
+                ('91d', '@{91d Tooltip}{%0.1f}% over @{Moving 91d # Aged}{#,##0}'),
+                ('182d', '@{182d Tooltip}{%0.1f}% over @{Moving 182d # Aged}{#,##0}'),
+                ('364d', '@{364d Tooltip}{%0.1f}% over @{Moving 364d # Aged}{#,##0}')
+            ],
+
+            formatters={
+                '@Date': 'datetime',
+                '@{28d Tooltip}': 'printf',
+                '@{91d Tooltip}': 'printf',
+                '@{182d Tooltip}': 'printf',
+                '@{364d Tooltip}': 'printf'
+            },
+
+            mode='vline',
+            line_policy='none',
+            toggleable=False
+        )
+
+        self.ct = ct
+
+        self.plot = figure(title='Referrals Seen in 30 Days - Moving Rates',
+                           output_backend='svg',
+                           x_axis_type='datetime',
+                           x_range=referrals_x_range,
+                           y_range=referrals_y_range,
+                           toolbar_location='below',
+                           tools=[PanTool(), BoxZoomTool(), SaveTool(), ResetTool()])
+
+        self.plot.yaxis[0].ticker.desired_num_ticks = 10
+        self.plot.yaxis.formatter = NumeralTickFormatter(format='0 %')
+        self.plot.yaxis.axis_label = "% Seen in 30d"
+        self.plot.yaxis.axis_label_text_font = "arial"
+        self.plot.yaxis.axis_label_text_font_size = "12pt"
+        self.plot.yaxis.axis_label_text_font_style = "normal"
+        self.plot.yaxis.axis_label_text_color = "#434244"
+        self.plot.yaxis.major_label_text_color = "#434244"
+        self.plot.yaxis.major_label_text_font = "arial"
+        self.plot.yaxis.major_label_text_font_size = "12pt"
+        self.plot.min_border_left = 60
+
+        self.plot.xaxis.major_label_text_font = "arial"
+        self.plot.xaxis.major_label_text_font_size = "10pt"
+        self.plot.xaxis.major_label_text_color = "#434244"
+
+        self.plot.title.text_color = '#434244'
+        self.plot.title.text_font = 'tahoma'
+        self.plot.title.text_font_size = '14pt'
+
+        self.lines = [self.plot.line(x='Date',
+                                     y='Moving 28d % Seen in 30d',
+                                     line_width=2,
+                                     line_dash='dotted',
+                                     line_color='gray',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     legend_label='28d',
+                                     source=self.cds),
+                      self.plot.line(x='Date',
+                                     y='Moving 91d % Seen in 30d',
+                                     line_width=2,
+                                     line_dash='dashed',
+                                     line_color='red',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     legend_label='91d',
+                                     source=self.cds),
+                      self.plot.line(x='Date',
+                                     y='Moving 182d % Seen in 30d',
+                                     line_width=2,
+                                     line_dash='solid',
+                                     line_color='blue',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     legend_label='182d',
+                                     source=self.cds),
+                      self.plot.line(x='Date',
+                                     y='Moving 364d % Seen in 30d',
+                                     line_width=2,
+                                     line_dash='solid',
+                                     line_color='black',
+                                     alpha=0.8,
+                                     muted_alpha=0.2,
+                                     legend_label='364d',
+                                     source=self.cds)]
+
+        self.plot.legend.location = 'bottom_left'
+        self.plot.legend.click_policy = 'mute'
+
+        self.plot.toolbar.logo = None
+
+        # The tooltips only apply to the moving rate lines, not to glyphs that are added to the figure later
+        ht.renderers = self.lines
+        self.plot.add_tools(ht)
+        self.plot.add_tools(self.ct)
+    # END __init__
+
+    def reset_y_range(self) -> None:
+        self.plot.y_range.start = 0.0
+        self.plot.y_range.end = 1.0
+
+    def get_figure(self) -> figure:
+        """Returns the Bokeh figure object associated with the plot"""
+        return self.plot
+
+    def get_source(self) -> ColumnDataSource:
+        """Returns the Bokeh ColumnDataSource object associated with the line glyphs"""
+        return self.cds
+
+    def get_lines(self) -> list[GlyphRenderer]:
+        """Returns a list of Bokeh GlyphRenderer objects for the line glyphs"""
+        return self.lines
+# END CLASS MovingRatesPlot
+
+
+def create_shared_crosshair() -> CrosshairTool:
+    height_overlay = Span(dimension="height", line_dash="solid", line_width=1, line_color='black')
+    return CrosshairTool(overlay=height_overlay, toggleable=False)
@@ -0,0 +1,133 @@
+"""
+Exports a standalone HTML report of the moving process rates for every clinic. Each report embeds its data in the page
+so that it can be emailed and opened without the Bokeh server.
+
+usage: python export_reports.py [--output-dir reports] [--data-file referrals.csv] [--workers N] [--clinic NAME ...]
+
+The rolling measures are calculated once by this process and handed to each worker process when it starts. The
+workers only render the plots for the clinics that they are given.
+"""
+
+import argparse
+import hashlib
+import html
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from bokeh.embed import file_html
+from bokeh.models import Div
+from bokeh.models.layouts import Column
+from bokeh.resources import CDN
+
+from referral_data import AS_OF_DATE, DATA_FILE, get_rolling_measures
+from clinic_plots import DailyVolumesPlot, MovingVolumesPlot, MovingRatesPlot, create_shared_crosshair
+
+
+# Rolling measures shared with each worker process by the pool initializer
+_worker_rolling_df = None
+_worker_start_dt = None
+
+
+def _init_worker(rolling_df: pd.DataFrame, start_dt) -> None:
+    """Stores the precalculated rolling measures in the worker process once, before any clinic is rendered."""
+    global _worker_rolling_df, _worker_start_dt
+    _worker_rolling_df = rolling_df
+    _worker_start_dt = start_dt
+# END _init_worker
+
+
+def create_report_file_name(clinic: str) -> str:
+    """Returns a file name for the report of the given clinic that is safe to use on any file system."""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', clinic).strip('_') + '.html'
+
+
+def create_report_file_names(clinics: list[str]) -> list[str]:
+    """
+    Returns the report file name of each clinic. Clinics whose safe names would be the same, such as A/B and A B, or
+    that differ only by case, get a short hash of the clinic name added so that no report overwrites another.
+    """
+    file_names = [create_report_file_name(clinic) for clinic in clinics]
+    counts = pd.Series(file_names).str.lower().value_counts()
+    for i, (clinic, file_name) in enumerate(zip(clinics, file_names)):
+        if counts[file_name.lower()] > 1 or file_name == '.html':
+            digest = hashlib.sha1(clinic.encode('utf-8')).hexdigest()[:8]
+            file_names[i] = f'{file_name[:-len(".html")]}_{digest}.html'.lstrip('_')
+    return file_names
+# END create_report_file_names
+
+
+def render_clinic_report(rolling_df: pd.DataFrame, start_dt, clinic: str) -> str:
+    """Returns a standalone HTML page with the moving rates, moving volumes, and daily volumes plots of a clinic."""
+    shared_crosshair = create_shared_crosshair()
+    rates_plot = MovingRatesPlot(rolling_df, start_dt, shared_crosshair, clinic)
+    volumes_plot = MovingVolumesPlot(rolling_df, start_dt, shared_crosshair, clinic)
+    daily_plot = DailyVolumesPlot(rolling_df, start_dt, shared_crosshair, clinic)
+    rates_plot.get_figure().height = 375
+    volumes_plot.get_figure().height = 200
+    daily_plot.get_figure().height = 200
+
+    # Show the same window sizes that the application shows by default
+    for i, line in enumerate(rates_plot.get_lines()):
+        line.visible = i in [1, 3]
+    for i, line in enumerate(volumes_plot.get_lines()):
+        line.visible = i in [1, 3]
+
+    title = Div(text=f'<h2>{html.escape(clinic)}</h2><p>Referrals as of {AS_OF_DATE:%Y-%m-%d}</p>')
+    layout = Column(title, rates_plot.get_figure(), volumes_plot.get_figure(), daily_plot.get_figure(), width=800)
+    return file_html(layout, CDN, f'Moving Process Rates - {clinic}')
+# END render_clinic_report
+
+
+def _export_clinic(clinic: str, file_path: str) -> str:
+    """Renders the report of one clinic in a worker process and returns the path of the file that was written."""
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(render_clinic_report(_worker_rolling_df, _worker_start_dt, clinic))
+    return file_path
+# END _export_clinic
+
+
+def export_reports(output_dir: str,
+                   data_file: str = DATA_FILE,
+                   clinics: list[str] = None,
+                   workers: int = None) -> list[str]:
+    """
+    Writes a standalone HTML report for each clinic and returns the paths of the files that were written.
+    :param output_dir: The folder to write the reports to
+    :param data_file: The path to the file with the referral data
+    :param clinics: The names of the clinics to export, or all clinics if not given
+    :param workers: The number of worker processes, or the number of processors if not given
+    :return: A list of the paths of the reports
+    """
+    rolling_df, start_dt, end_dt = get_rolling_measures(data_file)
+    if clinics is None:
+        clinics = rolling_df['Clinic'].unique().tolist()
+    os.makedirs(output_dir, exist_ok=True)
+    file_paths = [os.path.join(output_dir, file_name) for file_name in create_report_file_names(clinics)]
+
+    print(f'exporting {len(clinics)} clinic reports...')
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(rolling_df, start_dt)) as executor:
+        return list(executor.map(_export_clinic, clinics, file_paths, chunksize=8))
+# END export_reports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Export a standalone HTML report of moving rates for each clinic.')
+    parser.add_argument('--output-dir', default='reports', help='folder to write the reports to')
+    parser.add_argument('--data-file', default=DATA_FILE, help='path to the file with the referral data')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--clinic', action='append', dest='clinics', help='clinic to export, may be repeated')
+    args = parser.parse_args()
+
+    file_paths = export_reports(args.output_dir, args.data_file, args.clinics, args.workers)
+    print(f'wrote {len(file_paths)} reports to {args.output_dir}')
+# END main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+Measures how many simultaneous sessions one server process can handle. The harness starts the moving rates server on
+synthetic referral data, opens Bokeh client sessions against it, and replays interactions in every session: clinic
+switches, x-axis range drags, and window button toggles. It runs entirely offline.
+
+usage: python load_test.py [--sessions 20] [--interactions 30] [--think-time 0.2] [--referrals 100000] [--clinics 50]
+                           [--port 5106] [--seed 0] [--output load_test_results.json]
+
+The report includes the time to create a session, percentiles of the round-trip latency of each kind of interaction,
+and the growth of server memory per open session. The window buttons only run browser callbacks, so their round trip
+measures the Bokeh protocol alone and is a baseline for the interactions that run server callbacks.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+import numpy as np
+
+from bokeh.client import ClientSession, pull_session
+from bokeh.models import CheckboxButtonGroup, Select
+from bokeh.plotting import figure
+
+from clinic_plots import to_epoch_days
+from synthetic_referrals import write_synthetic_referrals
+
+
+SERVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'moving_rates_server.py')
+
+ACTIONS = ['clinic_switch', 'x_range_drag', 'window_toggle']
+
+# Interactions that have no server callback, so that their round trip is only the Bokeh protocol exchange
+PROTOCOL_ONLY_ACTIONS = ['window_toggle']
+
+
+def start_server(port: int, data_file: str) -> subprocess.Popen:
+    """Starts the moving rates server on the given data file and returns its process once it answers requests."""
+    env = dict(os.environ, REFERRALS_DATA_FILE=data_file)
+    process = subprocess.Popen([sys.executable, SERVER_FILE, '--port', str(port)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(600):
+        try:
+            get_server_metrics(port)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('the server stopped before it answered any requests')
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('the server did not answer requests within a minute')
+# END start_server
+
+
+def get_server_metrics(port: int) -> dict:
+    """Returns the metrics snapshot served by the server."""
+    with urlopen(f'http://localhost:{port}/metrics', timeout=5) as response:
+        return json.loads(response.read())
+
+
+def open_session(url: str) -> tuple[ClientSession, float]:
+    """Opens a client session of the application and returns it with the seconds that it took to create."""
+    start = time.perf_counter()
+    session = pull_session(url=url)
+    return session, time.perf_counter() - start
+# END open_session
+
+
+def replay_interactions(session: ClientSession, interactions: int, think_time: float, seed: int) -> dict:
+    """
+    Replays random interactions in a client session and returns the round-trip latency of each in seconds by the
+    kind of interaction. A round-trip ends when the server has applied the change and run its callbacks.
+    """
+    rng = random.Random(seed)
+    doc = session.document
+    clinic_select = [s for s in doc.select({'type': Select}) if '*ALL*' in s.options][0]
+    buttons = list(doc.select({'type': CheckboxButtonGroup}))[0]
+    plot = list(doc.select({'type': figure}))[0]
+    first_ms = to_epoch_days(plot.x_range.start) * 86400000.0
+    last_ms = to_epoch_days(plot.x_range.end) * 86400000.0
+
+    latencies = {action: [] for action in ACTIONS}
+    for _ in range(interactions):
+        action = rng.choice(ACTIONS)
+        start = time.perf_counter()
+        if action == 'clinic_switch':
+            clinic_select.value = rng.choice(clinic_select.options)
+        elif action == 'x_range_drag':
+            width = rng.uniform(0.1, 1.0) * (last_ms - first_ms)
+            range_start = rng.uniform(first_ms, last_ms - width)
+            plot.x_range.start = range_start
+            plot.x_range.end = range_start + width
+        else:
+            button = rng.randrange(len(buttons.labels))
+            active = set(buttons.active) ^ {button}
+            buttons.active = sorted(active)
+        session.force_roundtrip()
+        latencies[action].append(time.perf_counter() - start)
+        time.sleep(think_time)
+    return latencies
+# END replay_interactions
+
+
+def summarize(seconds: list[float]) -> dict:
+    """Returns the count and the percentiles in milliseconds of the given timings."""
+    if not seconds:
+        return {'count': 0}
+    ms = np.array(seconds) * 1000.0
+    return {'count': len(ms),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(ms.max())}
+# END summarize
+
+
+def run_load_test(sessions: int,
+                  interactions: int,
+                  think_time: float,
+                  num_referrals: int,
+                  num_clinics: int,
+                  port: int,
+                  seed: int) -> dict:
+    """Returns the results of a load test with the given number of concurrent sessions."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_file = os.path.join(data_dir, 'referrals.csv')
+        print(f'creating {num_referrals} synthetic referrals...')
+        write_synthetic_referrals(data_file, num_referrals=num_referrals, num_clinics=num_clinics, seed=seed)
+
+        print('starting server...')
+        server = start_server(port, data_file)
+        url = f'http://localhost:{port}/moving-process-rates'
+        try:
+            # The first session loads the shared rolling measures, which are not part of the memory of each session
+            warmup, warmup_seconds = open_session(url)
+            warmup.close()
+            rss_before = get_server_metrics(port)['rss_kb']
+
+            print(f'opening {sessions} sessions...')
+            with ThreadPoolExecutor(max_workers=sessions) as executor:
+                opened = list(executor.map(lambda i: open_session(url), range(sessions)))
+            rss_open = get_server_metrics(port)['rss_kb']
+
+            print(f'replaying {interactions} interactions in each session...')
+            with ThreadPoolExecutor(max_workers=sessions) as executor:
+                replayed = list(executor.map(
+                    lambda i: replay_interactions(opened[i][0], interactions, think_time, seed + i), range(sessions)))
+            metrics = get_server_metrics(port)
+
+            for session, seconds in opened:
+                session.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = {action: [s for r in replayed for s in r[action]] for action in ACTIONS}
+    return {'sessions': sessions,
+            'interactions_per_session': interactions,
+            'think_time_seconds': think_time,
+            'referrals': num_referrals,
+            'clinics': num_clinics,
+            'first_session_seconds': warmup_seconds,
+            'session_creation': summarize([seconds for session, seconds in opened]),
+            'round_trip': {action: summarize(latencies[action]) for action in ACTIONS},
+            'protocol_only_actions': PROTOCOL_ONLY_ACTIONS,
+            'server_rss_kb': {'before_sessions': rss_before,
+                              'with_sessions': rss_open,
+                              'after_replay': metrics['rss_kb']},
+            'server_rss_kb_per_session': ((rss_open - rss_before) / sessions
+                                          if rss_before is not None and rss_open is not None else None),
+            'server_callbacks': metrics['callbacks']}
+# END run_load_test
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test the moving rates application with concurrent sessions.')
+    parser.add_argument('--sessions', type=int, default=20, help='number of concurrent client sessions')
+    parser.add_argument('--interactions', type=int, default=30, help='number of interactions in each session')
+    parser.add_argument('--think-time', type=float, default=0.2, help='seconds between interactions')
+    parser.add_argument('--referrals', type=int, default=100000, help='number of synthetic referrals')
+    parser.add_argument('--clinics', type=int, default=50, help='number of synthetic clinics')
+    parser.add_argument('--port', type=int, default=5106, help='port for the server under test')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data and the interactions')
+    parser.add_argument('--output', default='load_test_results.json', help='file to write the results to')
+    args = parser.parse_args()
+
+    results = run_load_test(args.sessions, args.interactions, args.think_time, args.referrals, args.clinics,
+                            args.port, args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"session creation p50 {results['session_creation']['p50_ms']:.0f} ms, "
+          f"p90 {results['session_creation']['p90_ms']:.0f} ms")
+    for action, summary in results['round_trip'].items():
+        if summary['count']:
+            kind = 'protocol-only round trip' if action in PROTOCOL_ONLY_ACTIONS else 'round trip'
+            print(f"{action} {kind} p50 {summary['p50_ms']:.0f} ms, p90 {summary['p90_ms']:.0f} ms, "
+                  f"p99 {summary['p99_ms']:.0f} ms")
+    print(f"server memory per session {results['server_rss_kb_per_session']} KB")
+    print(f'wrote load test results to {args.output}')
+# END main
+
+
+if __name__ == '__main__':
+    main()
@@ -1,499 +1,387 @@
 from functools import partial
 
 import numpy as np
-from numpy.polynomial import Polynomial
 
 import pandas as pd
 
-from datetime import datetime
-
 from numpy import ndarray
 
+from datetime import datetime
+
 from bokeh.io import curdoc
+from bokeh.core.properties import value
 from bokeh.document import Document
 from bokeh.plotting import figure
 from bokeh.models import (ColumnDataSource, DateRangeSlider, RangeSlider, Select, CheckboxButtonGroup, CustomJS,
-                          GlyphRenderer, Div, Span)
-from bokeh.models.ranges import Range1d
+                          Div, MultiChoice, LegendItem, DatePicker)
 from bokeh.models.layouts import Column, Row
-from bokeh.models.formatters import NumeralTickFormatter
-from bokeh.models.tools import HoverTool, CrosshairTool, PanTool, BoxZoomTool, SaveTool, ResetTool
-
+from bokeh.models.tools import HoverTool
+from bokeh.palettes import Dark2
 
-class ClinicPlot:
-    """Base class used to identify plots with static methods to create plot data."""
-    @staticmethod
-    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
-        pass
+from referral_data import (DATA_FILE, RESOLUTIONS, TREND_MODELS, get_rolling_measures, get_snapshot_pyramid,
+                           get_rate_anomalies, get_snapshot_anomalies, get_complete_measures_date, rank_flagged_clinics)
+from clinic_plots import (ClinicPlot, DailyVolumesPlot, MovingVolumesPlot, MovingRatesPlot, VISIBLE_RANGE_TREND,
+                          create_shared_crosshair, to_epoch_days)
+from pipeline_metrics import stage_timer, timed_callback
+from view_cache import get_view_data
 
-    def get_source(self) -> ColumnDataSource:
-        pass
 
-    def reset_y_range(self) -> None:
-        pass
+WINDOW_LABELS = ['28d', '91d', '182d', '364d']
 
 
-class DailyVolumesPlot(ClinicPlot):
+class ClinicSlicer:
     """
-    Pairs a Bokeh figure and a ColumnDataSource that can be updated to change the figure. The figure is the plot of
-    daily referral volumes that make up the denominator of the moving rate that referrals are seen in 30d across
-    different window sizes.
+    This class creates a Bokeh Select model with a drop-down list of clinic names and pairs a callback function
+    with a ColumnDataSource that updates associated Bokeh models with a filtered data set. The filtered data sets are
+    served from the view cache that is shared by every session.
 
     Methods:
-         create_dataset - Returns a new DataFrame with data for this visual
-         reset_y_range - Reapplies the full y-axis range in the visual
-         get_figure - Returns the Bokeh figure object associated with the plot
-         get_source - Returns the Bokeh ColumnDataSource object associated with the line glyphs
-         get_lines - Returns a list of Bokeh GlyphRenderer objects for the line glyphs
+        set_level - Changes the resolution of the data and refreshes the plots with it
+        set_snapshot - Changes the as-of snapshot date of the data and refreshes the plots with it
+        get_slicer_model - Returns the Bokeh model object associated with the slicer widget
     """
 
-    @staticmethod
-    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
-        """Returns a new DataFrame with data for the visual extracted from the given DataFrame."""
-        data_df = source_df.loc[(source_df['Clinic'] == clinic),
-                                ['Date',
-                                 '# Aged']].copy()
-        f = Polynomial.fit(np.array(data_df['Date'], dtype=float), data_df['# Aged'], 1, full=False)
-        data_df['trend'] = (f.convert())(np.array(data_df['Date'], dtype=float))
-        return data_df
-    # END _create_dataset
-
     def __init__(self,
-                 rolling_df: pd.DataFrame,
-                 start_dt: datetime,
-                 ct: CrosshairTool) -> None:
-        """
-        Creates an instance of a daily volumes plot for the application document.
-        :param rolling_df: DataFrame containing the precalculated moving rate data
-        :param start_dt: The starting date for the plot x-axis
-        :param ct: A shared crosshair hover tool for all plots in the document
-        """
+                 plots: list[ClinicPlot],
+                 df: pd.DataFrame,
+                 clinic: str = '*ALL*') -> None:
+        self.plots = plots
+        self.level = 'Daily'
+        self.snapshot_dt = None
+        self.clinics = df['Clinic'].unique().tolist()[::1]
+        self.clinic_select = Select(value=clinic, options=self.clinics)
+        self.clinic_select.on_change("value", self._clinic_slicer_callback)
 
-        data_df = self.create_dataset(rolling_df, '*ALL*')
-        self.cds = ColumnDataSource(data=data_df)
-
-        referrals_x_range = Range1d(start_dt, AS_OF_DATE)
-
-        ht = HoverTool(
-            tooltips=[
-                ('date', '@Date{%F}'),
-                ('# Aged', '@{# Aged}{#,##0}')],
-
-            formatters={
-                '@Date': 'datetime'},
-
-            line_policy='none',
-            toggleable=False
-        )
-
-        self.ct = ct
-
-        self.plot = figure(title=None,
-                           output_backend='svg',
-                           x_axis_type='datetime',
-                           x_range=referrals_x_range,
-                           toolbar_location='below',
-                           tools=[PanTool(), BoxZoomTool(), SaveTool(), ResetTool()])
-
-        self.plot.yaxis.formatter = NumeralTickFormatter(format='#,##0')
-        self.plot.yaxis.axis_label = "Daily Volume"
-        self.plot.yaxis.axis_label_text_font = "arial"
-        self.plot.yaxis.axis_label_text_font_size = "12pt"
-        self.plot.yaxis.axis_label_text_font_style = "normal"
-        self.plot.yaxis.axis_label_text_color = "#434244"
-        self.plot.yaxis.major_label_text_color = "#434244"
-        self.plot.yaxis.major_label_text_font = "arial"
-        self.plot.yaxis.major_label_text_font_size = "12pt"
-        self.plot.min_border_left = 60
-
-        self.plot.xaxis.major_label_text_font = "arial"
-        self.plot.xaxis.major_label_text_font_size = "10pt"
-        self.plot.xaxis.major_label_text_color = "#434244"
-
-        self.glyphs = [self.plot.circle(x='Date',
-                                        y='# Aged',
-                                        alpha=0.2,
-                                        color='blue',
-                                        source=self.cds),
-                       self.plot.line(x='Date',
-                                      y='trend',
-                                      line_color='red',
-                                      line_dash='solid',
-                                      line_width=2,
-                                      source=self.cds)]
-
-        self.plot.add_tools(ht)
-        self.plot.add_tools(self.ct)
-    # END __init__
+    @timed_callback('clinic_slicer')
+    def _clinic_slicer_callback(self, attr: str, old, new) -> None:
+        """This function is assigned to Bokeh models as a callback and filters the data by clinic name."""
+        self._refresh_plots(new, True)
+    # END clinic_filter_callback
 
-    def reset_y_range(self) -> None:
-        max_y = (self.cds.data['# Aged']).max()
-        self.plot.y_range.start = 0
-        self.plot.y_range.end = max_y
+    def _refresh_plots(self, clinic: str, reset_y_range: bool) -> None:
+        """
+        Replaces the data of every plot with the view of the given clinic at the current resolution and date.
+        :param clinic: The clinic name
+        :param reset_y_range: Whether each plot reapplies its full y-axis range, or keeps the range it is zoomed to
+        """
+        views = [get_view_data(type(plot), clinic, self.level, self.snapshot_dt) for plot in self.plots]
+        if clinic != '*ALL*' and not any(len(next(iter(data.values()), [])) for data in views):
+            # The clinic has no referrals as of the snapshot date, so the slicer falls back to every clinic
+            self.clinic_select.value = '*ALL*'
+            return
+        for plot, data in zip(self.plots, views):
+            cds = plot.get_source()
+            cds.data = data
+            if reset_y_range:
+                plot.reset_y_range()
+    # END _refresh_plots
 
-    def get_figure(self) -> figure:
-        """Returns the Bokeh figure object associated with the plot"""
-        return self.plot
+    def set_level(self, level: str) -> None:
+        """Changes the resolution of the data and refreshes the plots with the selected clinic at the same y ranges."""
+        self.level = level
+        self._refresh_plots(self.clinic_select.value, False)
 
-    def get_source(self) -> ColumnDataSource:
-        """Returns the Bokeh ColumnDataSource object associated with the line glyphs"""
-        return self.cds
+    def set_snapshot(self, snapshot_dt: datetime) -> None:
+        """Changes the as-of snapshot date of the data, or None for the latest data, and refreshes the plots."""
+        self.snapshot_dt = snapshot_dt
+        self._refresh_plots(self.clinic_select.value, True)
 
-    def get_glyphs(self) -> list[GlyphRenderer]:
-        """Returns a list of Bokeh GlyphRenderer objects for the line glyphs"""
-        return self.glyphs
-# END CLASS DailyVolumesPlot
+    def get_slicer_model(self) -> Select:
+        """Returns the Bokeh model object associated with the slicer widget."""
+        return self.clinic_select
+# END CLASS DataFilterCallback
 
 
-class MovingVolumesPlot(ClinicPlot):
+class ResolutionSelector:
     """
-    Pairs a Bokeh figure and a ColumnDataSource that can be updated to change the figure. The figure is the plot of
-    moving referral volumes that are the denominator of the rate that referrals are seen in 30d across different window
-    sizes.
+    This class creates a Bokeh Select model with a drop-down list of resolutions that switches the plots between the
+    daily measures and the precalculated weekly and monthly rollups. The automatic resolution follows the span of the
+    visible x-axis range so that long spans are shown with fewer, coarser points.
 
     Methods:
-         create_dataset - Returns a new DataFrame with data for this visual
-         reset_y_range - Reapplies the full y-axis range in the visual
-         get_figure - Returns the Bokeh figure object associated with the plot
-         get_source - Returns the Bokeh ColumnDataSource object associated with the line glyphs
-         get_lines - Returns a list of Bokeh GlyphRenderer objects for the line glyphs
+        get_selector_model - Returns the Bokeh model object associated with the selector widget
     """
 
-    @staticmethod
-    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
-        """Returns a new DataFrame with data for the visual extracted from the given DataFrame."""
-        data_df = source_df.loc[(source_df['Clinic'] == clinic),
-                                ['Date',
-                                 'Moving 28d % Seen in 30d',
-                                 'Moving 91d % Seen in 30d',
-                                 'Moving 182d % Seen in 30d',
-                                 'Moving 364d % Seen in 30d',
-                                 'Moving 28d # Aged',
-                                 'Moving 91d # Aged',
-                                 'Moving 182d # Aged',
-                                 'Moving 364d # Aged']].copy()
-        data_df['28d Tooltip'] = data_df['Moving 28d % Seen in 30d'] * 100.0
-        data_df['91d Tooltip'] = data_df['Moving 91d % Seen in 30d'] * 100.0
-        data_df['182d Tooltip'] = data_df['Moving 182d % Seen in 30d'] * 100.0
-        data_df['364d Tooltip'] = data_df['Moving 364d % Seen in 30d'] * 100.0
-        return data_df
-    # END _create_dataset
+    # The shortest visible span in days that is shown at each coarser resolution
+    AUTO_SPANS = [(730, 'Monthly'), (180, 'Weekly')]
 
     def __init__(self,
-                 rolling_df: pd.DataFrame,
-                 start_dt: datetime,
-                 ct: CrosshairTool) -> None:
-        """
-        Creates an instance of a moving volumes plot for the application document.
-        :param rolling_df: DataFrame containing the precalculated moving rate data
-        :param start_dt: The starting date for the plot x-axis
-        :param ct: A shared crosshair hover tool for all plots in the document
-        """
-
-        data_df = self.create_dataset(rolling_df, '*ALL*')
-        self.cds = ColumnDataSource(data=data_df)
-
-        referrals_x_range = Range1d(start_dt, AS_OF_DATE)
-
-        ht = HoverTool(
-            tooltips=[
-                ('date', '@Date{%F}'),
-                ('28d', '@{28d Tooltip}{%0.1f}% over @{Moving 28d # Aged}{#,##0}'),
-                ('91d', '@{91d Tooltip}{%0.1f}% over @{Moving 91d # Aged}{#,##0}'),
-                ('182d', '@{182d Tooltip}{%0.1f}% over @{Moving 182d # Aged}{#,##0}'),
-                ('364d', '@{364d Tooltip}{%0.1f}% over @{Moving 364d # Aged}{#,##0}')
-            ],
-
-            formatters={
-                '@Date': 'datetime',
-                '@{28d Tooltip}': 'printf',
-                '@{91d Tooltip}': 'printf',
-                '@{182d Tooltip}': 'printf',
-                '@{364d Tooltip}': 'printf'
-            },
-
-            mode='vline',
-            line_policy='none',
-            toggleable=False
-        )
-
-        self.ct = ct
-
-        self.plot = figure(title=None,
-                           output_backend='svg',
-                           x_axis_type='datetime',
-                           x_range=referrals_x_range,
-                           toolbar_location='below',
-                           tools=[PanTool(), BoxZoomTool(), SaveTool(), ResetTool()])
-
-        self.plot.yaxis.formatter = NumeralTickFormatter(format='#,##0')
-        self.plot.yaxis.axis_label = "Moving Volume"
-        self.plot.yaxis.axis_label_text_font = "arial"
-        self.plot.yaxis.axis_label_text_font_size = "12pt"
-        self.plot.yaxis.axis_label_text_font_style = "normal"
-        self.plot.yaxis.axis_label_text_color = "#434244"
-        self.plot.yaxis.major_label_text_color = "#434244"
-        self.plot.yaxis.major_label_text_font = "arial"
-        self.plot.yaxis.major_label_text_font_size = "12pt"
-        self.plot.min_border_left = 60
-
-        self.plot.xaxis.major_label_text_font = "arial"
-        self.plot.xaxis.major_label_text_font_size = "10pt"
-        self.plot.xaxis.major_label_text_color = "#434244"
-
-        self.lines = [self.plot.line(x='Date',
-                                     y='Moving 28d # Aged',
-                                     line_width=2,
-                                     line_dash='dotted',
-                                     line_color='gray',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     source=self.cds),
-                      self.plot.line(x='Date',
-                                     y='Moving 91d # Aged',
-                                     line_width=2,
-                                     line_dash='dashed',
-                                     line_color='red',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     source=self.cds),
-                      self.plot.line(x='Date',
-                                     y='Moving 182d # Aged',
-                                     line_width=2,
-                                     line_dash='solid',
-                                     line_color='blue',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     source=self.cds),
-                      self.plot.line(x='Date',
-                                     y='Moving 364d # Aged',
-                                     line_width=2,
-                                     line_dash='solid',
-                                     line_color='black',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     source=self.cds)]
-
-        self.plot.add_tools(ht)
-        self.plot.add_tools(self.ct)
+                 slicer: ClinicSlicer,
+                 plot: figure) -> None:
+        self.slicer = slicer
+        self.plot = plot
+        self.level = 'Daily'
+        self.resolution_select = Select(value='Daily', options=['Auto'] + list(RESOLUTIONS))
+        self.resolution_select.on_change('value', self._resolution_callback)
+        self.plot.x_range.on_change('start', self._resolution_callback)
+        self.plot.x_range.on_change('end', self._resolution_callback)
     # END __init__
 
-    def reset_y_range(self) -> None:
-        max_28d = (self.cds.data['Moving 28d # Aged']).max()
-        max_91d = (self.cds.data['Moving 91d # Aged']).max()
-        max_182d = (self.cds.data['Moving 182d # Aged']).max()
-        max_364d = (self.cds.data['Moving 364d # Aged']).max()
-        max_y = max(max_28d, max_91d, max_182d, max_364d)
-        self.plot.y_range.start = 0
-        self.plot.y_range.end = max_y
-
-    def get_figure(self) -> figure:
-        """Returns the Bokeh figure object associated with the plot"""
-        return self.plot
-
-    def get_source(self) -> ColumnDataSource:
-        """Returns the Bokeh ColumnDataSource object associated with the line glyphs"""
-        return self.cds
-
-    def get_lines(self) -> list[GlyphRenderer]:
-        """Returns a list of Bokeh GlyphRenderer objects for the line glyphs"""
-        return self.lines
-    # END CLASS MovingVolumesPlot
-
-
-class MovingRatesPlot(ClinicPlot):
+    def _get_auto_level(self) -> str:
+        """Returns the resolution for the span of the visible x-axis range."""
+        span = to_epoch_days(self.plot.x_range.end) - to_epoch_days(self.plot.x_range.start)
+        for days, level in self.AUTO_SPANS:
+            if span >= days:
+                return level
+        return 'Daily'
+
+    @timed_callback('resolution')
+    def _resolution_callback(self, attr: str, old, new) -> None:
+        """This function is assigned to Bokeh models as a callback and switches the data to the chosen resolution."""
+        level = self.resolution_select.value
+        if level == 'Auto':
+            level = self._get_auto_level()
+        if level != self.level:
+            self.level = level
+            self.slicer.set_level(level)
+    # END _resolution_callback
+
+    def get_selector_model(self) -> Select:
+        """Returns the Bokeh model object associated with the selector widget."""
+        return self.resolution_select
+# END CLASS ResolutionSelector
+
+
+class AnomalyFlags:
     """
-    Pairs a Bokeh figure and a ColumnDataSource that can be updated to change the figure. The figure is the plot of
-    moving rates that referrals are seen in 30d across different window sizes.
+    This class marks the dates where the moving rate of the selected clinic dropped on the moving rates plot, and
+    creates a Bokeh Select model with a drop-down list of the clinics with recent flags, ranked by the number of flags,
+    that jumps the clinic slicer to the chosen clinic.
 
     Methods:
-         create_dataset - Returns a new DataFrame with data for this visual
-         reset_y_range - Reapplies the full y-axis range in the visual
-         get_figure - Returns the Bokeh figure object associated with the plot
-         get_source - Returns the Bokeh ColumnDataSource object associated with the line glyphs
-         get_lines - Returns a list of Bokeh GlyphRenderer objects for the line glyphs
+        set_flags - Replaces the flags that are marked and ranked
+        get_ranking_model - Returns the Bokeh model object associated with the ranked clinic widget
     """
 
-    @staticmethod
-    def create_dataset(source_df: pd.DataFrame, clinic: str) -> pd.DataFrame:
-        """Returns a new DataFrame with data for the visual extracted from the given DataFrame."""
-        data_df = source_df.loc[(source_df['Clinic'] == clinic),
-                                ['Date',
-                                 'Moving 28d % Seen in 30d',
-                                 'Moving 91d % Seen in 30d',
-                                 'Moving 182d % Seen in 30d',
-                                 'Moving 364d % Seen in 30d',
-                                 'Moving 28d # Aged',
-                                 'Moving 91d # Aged',
-                                 'Moving 182d # Aged',
-                                 'Moving 364d # Aged']].copy()
-        data_df['28d Tooltip'] = data_df['Moving 28d % Seen in 30d'] * 100.0
-        data_df['91d Tooltip'] = data_df['Moving 91d % Seen in 30d'] * 100.0
-        data_df['182d Tooltip'] = data_df['Moving 182d % Seen in 30d'] * 100.0
-        data_df['364d Tooltip'] = data_df['Moving 364d % Seen in 30d'] * 100.0
-        return data_df
-    # END _create_dataset
-
-    def __init__(self, rolling_df: pd.DataFrame, start_dt: datetime, ct: CrosshairTool) -> None:
-        """
-        Creates an instance of a moving rates plot for the application document.
-        :param rolling_df: DataFrame containing the precalculated moving rate data
-        :param start_dt: The starting date for the plot x-axis
-        :param ct: A shared crosshair hover tool for all plots in the document
-        """
-        data_df = self.create_dataset(rolling_df, '*ALL*')
-        self.cds = ColumnDataSource(data=data_df)
-
-        referrals_x_range = Range1d(start_dt, AS_OF_DATE)
-        referrals_y_range = Range1d(0.0, 1.0)
-
-        ht = HoverTool(
-            tooltips=[
-                ('date', '@Date{%F}'),
-                ('28d', '@{28d Tooltip}{%0.1f}% over @{Moving 28d # Aged}{#,##0}'),
-                ('91d', '@{91d Tooltip}{%0.1f}% over @{Moving 91d # Aged}{#,##0}'),
-                ('182d', '@{182d Tooltip}{%0.1f}% over @{Moving 182d # Aged}{#,##0}'),
-                ('364d', '@{364d Tooltip}{%0.1f}% over @{Moving 364d # Aged}{#,##0}')
-            ],
-
-            formatters={
-                '@Date': 'datetime',
-                '@{28d Tooltip}': 'printf',
-                '@{91d Tooltip}': 'printf',
-                '@{182d Tooltip}': 'printf',
-                '@{364d Tooltip}': 'printf'
-            },
-
-            mode='vline',
-            line_policy='none',
-            toggleable=False
-        )
-
-        self.ct = ct
-
-        self.plot = figure(title='Referrals Seen in 30 Days - Moving Rates',
-                           output_backend='svg',
-                           x_axis_type='datetime',
-                           x_range=referrals_x_range,
-                           y_range=referrals_y_range,
-                           toolbar_location='below',
-                           tools=[PanTool(), BoxZoomTool(), SaveTool(), ResetTool()])
-
-        self.plot.yaxis[0].ticker.desired_num_ticks = 10
-        self.plot.yaxis.formatter = NumeralTickFormatter(format='0 %')
-        self.plot.yaxis.axis_label = "% Seen in 30d"
-        self.plot.yaxis.axis_label_text_font = "arial"
-        self.plot.yaxis.axis_label_text_font_size = "12pt"
-        self.plot.yaxis.axis_label_text_font_style = "normal"
-        self.plot.yaxis.axis_label_text_color = "#434244"
-        self.plot.yaxis.major_label_text_color = "#434244"
-        self.plot.yaxis.major_label_text_font = "arial"
-        self.plot.yaxis.major_label_text_font_size = "12pt"
-        self.plot.min_border_left = 60
-
-        self.plot.xaxis.major_label_text_font = "arial"
-        self.plot.xaxis.major_label_text_font_size = "10pt"
-        self.plot.xaxis.major_label_text_color = "#434244"
-
-        self.plot.title.text_color = '#434244'
-        self.plot.title.text_font = 'tahoma'
-        self.plot.title.text_font_size = '14pt'
-
-        self.lines = [self.plot.line(x='Date',
-                                     y='Moving 28d % Seen in 30d',
-                                     line_width=2,
-                                     line_dash='dotted',
-                                     line_color='gray',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     legend_label='28d',
-                                     source=self.cds),
-                      self.plot.line(x='Date',
-                                     y='Moving 91d % Seen in 30d',
-                                     line_width=2,
-                                     line_dash='dashed',
-                                     line_color='red',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     legend_label='91d',
-                                     source=self.cds),
-                      self.plot.line(x='Date',
-                                     y='Moving 182d % Seen in 30d',
-                                     line_width=2,
-                                     line_dash='solid',
-                                     line_color='blue',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     legend_label='182d',
-                                     source=self.cds),
-                      self.plot.line(x='Date',
-                                     y='Moving 364d % Seen in 30d',
-                                     line_width=2,
-                                     line_dash='solid',
-                                     line_color='black',
-                                     alpha=0.8,
-                                     muted_alpha=0.2,
-                                     legend_label='364d',
-                                     source=self.cds)]
-
-        self.plot.legend.location = 'bottom_left'
-        self.plot.legend.click_policy = 'mute'
-
-        self.plot.toolbar.logo = None
-
-        self.plot.add_tools(ht)
-        self.plot.add_tools(self.ct)
-    # END __init__
-
-    def reset_y_range(self) -> None:
-        self.plot.y_range.start = 0.0
-        self.plot.y_range.end = 1.0
+    MARKERS = {'Drop': 'inverted_triangle', 'Shift': 'diamond'}
 
-    def get_figure(self) -> figure:
-        """Returns the Bokeh figure object associated with the plot"""
-        return self.plot
-
-    def get_source(self) -> ColumnDataSource:
-        """Returns the Bokeh ColumnDataSource object associated with the line glyphs"""
-        return self.cds
+    def __init__(self,
+                 plot: MovingRatesPlot,
+                 slicer: ClinicSlicer,
+                 flag_df: pd.DataFrame,
+                 end_dt: datetime) -> None:
+        self.slicer = slicer
+        self.flag_df = flag_df
+        self.end_dt = end_dt
+        self.cds = ColumnDataSource(data=self._create_data(slicer.get_slicer_model().value))
+
+        fig = plot.get_figure()
+        self.markers = fig.scatter(x='Date',
+                                   y='Moving 28d % Seen in 30d',
+                                   marker='Marker',
+                                   size=11,
+                                   fill_color='firebrick',
+                                   line_color='white',
+                                   source=self.cds)
+        fig.add_tools(HoverTool(renderers=[self.markers],
+                                tooltips=[('flag', '@Kind on @Date{%F}'), ('score', '@Score{0.00}'),
+                                          ('28d rate', '@{Moving 28d % Seen in 30d}{0.0 %}')],
+                                formatters={'@Date': 'datetime'},
+                                toggleable=False))
+        fig.legend[0].items.append(LegendItem(label='Flagged drops and shifts', renderers=[self.markers]))
+
+        self.ranking_select = Select(value='', options=self._create_options())
+        self.ranking_select.on_change('value', self._ranking_callback)
+        slicer.get_slicer_model().on_change('value', self._clinic_callback)
+    # END __init__
 
-    def get_lines(self) -> list[GlyphRenderer]:
-        """Returns a list of Bokeh GlyphRenderer objects for the line glyphs"""
-        return self.lines
-# END CLASS MovingRatesPlot
+    def _create_data(self, clinic: str) -> dict[str, ndarray]:
+        """Returns a dictionary of data for the marker glyphs with the flags of the given clinic."""
+        data_df = self.flag_df.loc[self.flag_df['Clinic'] == clinic].copy()
+        data_df['Marker'] = data_df['Kind'].map(self.MARKERS)
+        return create_dict_like_bokeh_does(data_df)
+
+    def _create_options(self) -> list[tuple[str, str]]:
+        """Returns the options of the ranked clinic drop-down list as pairs of clinic names and labels."""
+        rank_df = rank_flagged_clinics(self.flag_df, self.end_dt)
+        options = [('', f'Flagged in the last 91 days: {len(rank_df)}')]
+        for clinic, flags in zip(rank_df['Clinic'], rank_df['# Flags']):
+            options.append((clinic, f'{clinic} - flags: {flags}'))
+        return options
+
+    def _clinic_callback(self, attr: str, old, new) -> None:
+        """This function is assigned to the clinic slicer as a callback and marks the flags of the chosen clinic."""
+        self.cds.data = self._create_data(new)
+
+    @timed_callback('anomaly_ranking')
+    def _ranking_callback(self, attr: str, old, new) -> None:
+        """This function is assigned to Bokeh models as a callback and jumps the clinic slicer to a flagged clinic."""
+        if new:
+            self.slicer.get_slicer_model().value = new
+            # The list goes back to its summary so that choosing the same clinic again jumps to it again
+            self.ranking_select.value = ''
+    # END _ranking_callback
+
+    def set_flags(self, flag_df: pd.DataFrame, end_dt: datetime) -> None:
+        """Replaces the flags that are marked on the plot and ranked in the drop-down list up to the given date."""
+        self.flag_df = flag_df
+        self.end_dt = end_dt
+        self.cds.data = self._create_data(self.slicer.get_slicer_model().value)
+        self.ranking_select.update(value='', options=self._create_options())
+
+    def get_ranking_model(self) -> Select:
+        """Returns the Bokeh model object associated with the ranked clinic widget."""
+        return self.ranking_select
+# END CLASS AnomalyFlags
+
+
+class SnapshotSelector:
+    """
+    This class creates a Bokeh DatePicker model that replays the measures as they would have been shown on a past
+    date. Seen dates after the snapshot date are ignored and measures after it are left out. The latest date shows the
+    measures of all referral data.
 
+    Methods:
+        get_picker_model - Returns the Bokeh model object associated with the date picker widget
+    """
 
-class ClinicSlicer:
+    def __init__(self,
+                 slicer: ClinicSlicer,
+                 comparison: 'ClinicComparison',
+                 flags: AnomalyFlags,
+                 first_dt: datetime,
+                 last_dt: datetime) -> None:
+        self.slicer = slicer
+        self.comparison = comparison
+        self.flags = flags
+        self.last_dt = pd.Timestamp(last_dt)
+        self.date_picker = DatePicker(value=self.last_dt.date(), min_date=pd.Timestamp(first_dt).date(),
+                                      max_date=self.last_dt.date())
+        self.date_picker.on_change('value', self._snapshot_callback)
+
+    @timed_callback('snapshot')
+    def _snapshot_callback(self, attr: str, old, new) -> None:
+        """This function is assigned to Bokeh models as a callback and switches the measures to the chosen date."""
+        snapshot_dt = pd.Timestamp(new)
+        if snapshot_dt >= self.last_dt:
+            self.slicer.set_snapshot(None)
+            self.comparison.set_data(get_rolling_measures(DATA_FILE)[0])
+            self.flags.set_flags(get_rate_anomalies(DATA_FILE), get_complete_measures_date(self.last_dt))
+        else:
+            self.slicer.set_snapshot(snapshot_dt)
+            self.comparison.set_data(get_snapshot_pyramid(snapshot_dt, DATA_FILE)['Daily'])
+            self.flags.set_flags(get_snapshot_anomalies(snapshot_dt, DATA_FILE),
+                                 get_complete_measures_date(snapshot_dt))
+    # END _snapshot_callback
+
+    def get_picker_model(self) -> DatePicker:
+        """Returns the Bokeh model object associated with the date picker widget."""
+        return self.date_picker
+# END CLASS SnapshotSelector
+
+
+class ClinicComparison:
     """
-    This class creates a Bokeh Select model with a drop-down list of clinic names and pairs a callback function
-    with a ColumnDataSource that updates associated Bokeh models with a filtered data set.
+    This class creates a Bokeh MultiChoice model of clinic names and a Select model of window sizes that overlay one
+    moving rate line per chosen clinic on the moving rates plot. The moving rates for every clinic are pivoted once
+    into a date by clinic matrix for each window size so that a change in the selection is served by a single slice
+    of that matrix. A fixed pool of line glyphs shares one ColumnDataSource and is reused for every selection.
 
     Methods:
-        get_slicer_model - Returns the Bokeh model object associated with the slicer widget
+        set_data - Replaces the moving rates that are compared and refreshes the chosen clinics
+        get_clinics_model - Returns the Bokeh model object associated with the clinic selection widget
+        get_window_model - Returns the Bokeh model object associated with the window selection widget
     """
 
     def __init__(self,
-                 plots: list[ClinicPlot],
-                 df: pd.DataFrame) -> None:
-        self.plots = plots
-        self.df = df
-        self.clinics = df['Clinic'].unique().tolist()[::1]
-        self.clinic_select = Select(value='*ALL*', options=self.clinics)
-        self.clinic_select.on_change("value", self._clinic_slicer_callback)
-
-    def _clinic_slicer_callback(self, attr: str, old, new) -> None:
-        """This function is assigned to Bokeh models as a callback and filters the data by clinic name."""
-        for plot in self.plots:
-            data_df = plot.create_dataset(self.df, new)
-            cds = plot.get_source()
-            cds.data = create_dict_like_bokeh_does(data_df)
-            plot.reset_y_range()
-    # END clinic_filter_callback
+                 plot: MovingRatesPlot,
+                 df: pd.DataFrame,
+                 max_clinics: int = 8) -> None:
+        self.plot = plot
+        self.windows = ['28d', '91d', '182d', '364d']
+        self.slots = [f'Compare {i}' for i in range(max_clinics)]
+
+        self.clinics = df.loc[df['Clinic'] != '*ALL*', 'Clinic'].unique().tolist()
+        self.clinic_index = {clinic: i for i, clinic in enumerate(self.clinics)}
+        self._pivot_rates(df)
+
+        self.cds = ColumnDataSource(data=self._create_data([], self.windows[3]))
+
+        colors = Dark2[max_clinics] if max_clinics in Dark2 else Dark2[8]
+        self.lines = []
+        self.legend_items = []
+        for i, slot in enumerate(self.slots):
+            line = self.plot.get_figure().line(x='Date',
+                                               y=slot,
+                                               line_width=2,
+                                               line_color=colors[i % len(colors)],
+                                               alpha=0.8,
+                                               muted_alpha=0.2,
+                                               visible=False,
+                                               name=slot,
+                                               source=self.cds)
+            self.lines.append(line)
+            self.legend_items.append(LegendItem(label=slot, renderers=[line], visible=False))
+        self.plot.get_figure().legend[0].items.extend(self.legend_items)
+        # The name of each pooled line is the label of the clinic it shows, which its tooltip shows with the rate
+        self.plot.get_figure().add_tools(HoverTool(renderers=self.lines,
+                                                   tooltips=[('clinic', '$name'), ('date', '@Date{%F}'),
+                                                             ('rate', '$snap_y{0.0 %}')],
+                                                   formatters={'@Date': 'datetime'},
+                                                   line_policy='nearest',
+                                                   toggleable=False))
+
+        self.clinic_choice = MultiChoice(value=[], options=self.clinics, max_items=max_clinics,
+                                         placeholder='Choose clinics to compare')
+        self.window_select = Select(value=self.windows[3], options=self.windows)
+        self.clinic_choice.on_change('value', self._comparison_callback)
+        self.window_select.on_change('value', self._comparison_callback)
+    # END __init__
 
-    def get_slicer_model(self) -> Select:
-        """Returns the Bokeh model object associated with the slicer widget."""
-        return self.clinic_select
-# END CLASS DataFilterCallback
+    def _pivot_rates(self, df: pd.DataFrame) -> None:
+        """
+        Pivots the moving rates of every window into one date by clinic matrix per window, filling the days without
+        a measure the same way that a line glyph connects the points on either side of them.
+        """
+        calendar = pd.DatetimeIndex(df['Date'].unique()).sort_values()
+        clinic_df = df.loc[df['Clinic'] != '*ALL*']
+        self.dates = calendar.values
+        self.rates = {}
+        for window in self.windows:
+            rate_df = (
+                clinic_df.pivot(index='Date', columns='Clinic', values=f'Moving {window} % Seen in 30d')
+                .reindex(index=calendar, columns=self.clinics)
+                .interpolate(method='index', limit_area='inside'))
+            self.rates[window] = rate_df.to_numpy(dtype=float)
+    # END _pivot_rates
+
+    def _create_data(self, clinics: list[str], window: str) -> dict[str, ndarray]:
+        """Returns a dictionary of data for the pooled line glyphs with one column per slot in the pool."""
+        idx = [self.clinic_index[clinic] for clinic in clinics]
+        selected = self.rates[window][:, idx]
+        data = {'Date': self.dates}
+        empty = np.full(len(self.dates), np.nan)
+        for i, slot in enumerate(self.slots):
+            data[slot] = selected[:, i] if i < len(idx) else empty
+        return data
+
+    @timed_callback('clinic_comparison')
+    def _comparison_callback(self, attr: str, old, new) -> None:
+        """This function is assigned to Bokeh models as a callback and overlays the chosen clinics on the plot."""
+        clinics = self.clinic_choice.value[:len(self.slots)]
+        window = self.window_select.value
+        self.cds.data = self._create_data(clinics, window)
+        for i, (line, item) in enumerate(zip(self.lines, self.legend_items)):
+            if i < len(clinics):
+                item.label = value(f'{clinics[i]} {window}')
+                line.name = f'{clinics[i]} {window}'
+            line.visible = i < len(clinics)
+            item.visible = i < len(clinics)
+    # END _comparison_callback
+
+    def set_data(self, df: pd.DataFrame) -> None:
+        """Replaces the moving rates that are compared and refreshes the lines of the chosen clinics."""
+        self._pivot_rates(df)
+        self._comparison_callback('value', self.clinic_choice.value, self.clinic_choice.value)
+
+    def get_clinics_model(self) -> MultiChoice:
+        """Returns the Bokeh model object associated with the clinic selection widget."""
+        return self.clinic_choice
+
+    def get_window_model(self) -> Select:
+        """Returns the Bokeh model object associated with the window selection widget."""
+        return self.window_select
+# END CLASS ClinicComparison
 
 
 class ConnectedXDateRangeSlider:
@@ -546,6 +434,7 @@ class ConnectedXDateRangeSlider:
                 plot.x_range.start = new[0]
                 plot.x_range.end = new[1]
 
+    @timed_callback('x_range_from_plot')
     def _update_ranges_from_plot(self, attr, old, new, plot: figure) -> None:
         """Updates the start and end range values in the slider and the x-axes of connected plots from a given plot."""
         # Stop changes caused by this callback from reflecting as another callback
@@ -555,6 +444,7 @@ class ConnectedXDateRangeSlider:
         self._update_ranges(new_value, plot)
         self._enable_callbacks(plot)
 
+    @timed_callback('x_range_slider')
     def _update_plot_ranges_from_slider(self, attr, old, new) -> None:
         """Updates the start and end range values in the x-axis of all plots using the values from the slider."""
         # Stop changes caused by this callback from reflecting as another callback
@@ -593,6 +483,7 @@ class ConnectedYRangeSlider:
         self.plot.y_range.on_change('end', self._update_slider_end)
     # END __init__
 
+    @timed_callback('y_range_from_plot')
     def _update_slider_start(self, attr, old, new):
         """Updates the start value in the range slider's value tuple with the given new value."""
         self.slider.remove_on_change('value', self._update_plot_range)
@@ -605,6 +496,7 @@ class ConnectedYRangeSlider:
         self.slider.on_change('value', self._update_plot_range)
     # END _update_slider_start
 
+    @timed_callback('y_range_from_plot')
     def _update_slider_end(self, attr, old, new):
         """Updates the end value in the range slider's value tuple with the given new value."""
         self.slider.remove_on_change('value', self._update_plot_range)
@@ -617,6 +509,7 @@ class ConnectedYRangeSlider:
         self.slider.on_change('value', self._update_plot_range)
     # END _update_slider_end
 
+    @timed_callback('y_range_slider')
     def _update_plot_range(self, attr, old, new):
         """Updates the plot figure's y-axis start and end values from the given new range tuple."""
         self.plot.y_range.remove_on_change('start', self._update_slider_start)
@@ -636,48 +529,6 @@ class ConnectedYRangeSlider:
 # END CLASS ConnectedYRangeSlider
 
 
-DATE_COLUMNS = ['Date Referral Sent',
-                'Date Referral Seen',
-                'Date Patient Checked In',
-                'Date Held',
-                'Date Pending Reschedule',
-                'Date Last Referral Update',
-                'Date Similar Appt Scheduled',
-                'Date Accepted',
-                'Date Referral Written',
-                'Date Referral Completed',
-                'Date Referral Scheduled']
-
-COLUMN_TYPES = {
-    'Referral ID': 'string',
-    'Source Location': 'string',
-    'Provider Referred To': 'string',
-    'Location Referred To': 'string',
-    'Referral Priority': 'string',
-    'Referral Status': 'string',
-    'Patient ID': 'string',
-    'Clinic': 'string',
-    'Last Referral Update By': 'string',
-    'Assigned Personnel': 'string',
-    'Organization Referred To': 'string',
-    'Reason for Hold': 'string',
-    'Referral Sub-Status': 'string',
-    'Date Referral Sent': 'object',
-    'Date Referral Seen': 'object',
-    'Date Patient Checked In': 'object',
-    'Date Held': 'object',
-    'Date Pending Reschedule': 'object',
-    'Date Last Referral Update': 'object',
-    'Date Similar Appt Scheduled': 'object',
-    'Date Accepted': 'object',
-    'Date Referral Written': 'object',
-    'Date Referral Completed': 'object',
-    'Date Referral Scheduled': 'object'}
-
-DATA_FILE = 'referrals.csv'
-AS_OF_DATE = datetime(2023, 3, 1)
-
-
 def create_dict_like_bokeh_does(df: pd.DataFrame) -> dict[str, ndarray]:
     """Returns a dictionary of data from a DataFrame with columns as ndarrays and proper typecasting."""
     tmp_data = {c: v.values for c, v in df.items()}
@@ -688,167 +539,12 @@ def create_dict_like_bokeh_does(df: pd.DataFrame) -> dict[str, ndarray]:
 # END create_dict_like_bokeh_does
 
 
-def load_data(file_path: str, columns: dict[str, str], date_columns: list[str]) -> pd.DataFrame:
-    """
-    Extracts referral data from a text file and returns a DataFrame.
-    :param file_path: The path to the file with the referral data
-    :param columns: The names and intended data types of each column in the file
-    :param date_columns: The names of the columns to be typecast as datetime
-    :return: A dataframe of referral data
-    """
-    df = pd.read_csv(file_path, header=0, dtype=columns)
-    # This seems to work better than asking read_csv to convert datetime columns
-    df[date_columns] = df[date_columns].apply(pd.to_datetime)
-    return df
-# END load_data
-
-
-def get_measurement_dates(df: pd.DataFrame) -> tuple[datetime, datetime]:
-    """Returns a tuple with the first and last measurement dates from the given DataFrame of referral data."""
-    start_dt = min(df['Date Referral Sent +31d'])
-    end_dt = max(df['Date Referral Sent +31d'])
-    return start_dt, end_dt
-# END get_measurement_dates
-
-
-def create_calendar(start_dt: datetime, end_dt: datetime) -> pd.DataFrame:
-    """Returns a DataFrame with all calendar dates across a given range of dates."""
-    return pd.DataFrame({'Date': pd.date_range(start_dt, end_dt)})
-
-
-def process_record_transforms(df: pd.DataFrame) -> None:
-    """Adds columns of record specific measurements to the given DataFrame of referral data."""
-
-    # Create an offset date when the referral reached 30 days of age
-    df['Date Referral Sent +31d'] = df['Date Referral Sent'] + pd.Timedelta(days=31)
-    df['As Of Date'] = AS_OF_DATE
-
-    # Days until the referral tagged as seen or patient checked into clinic appointment
-    df['Date Patient Seen or Checked In'] = df['Date Referral Seen']
-    idx = df['Date Patient Seen or Checked In'].isna()
-    df.loc[idx, 'Date Patient Seen or Checked In'] = df.loc[idx, 'Date Patient Checked In']
-    df['Days until Patient Seen or Check In'] = (
-            (df['Date Patient Seen or Checked In'] -
-             df['Date Referral Sent']) / pd.Timedelta(days=1))
-    idx = df['Date Patient Seen or Checked In'].isna()
-    df.loc[idx, 'Days until Patient Seen or Check In'] = (
-            (df.loc[idx, 'As Of Date'] - df.loc[idx, 'Date Referral Sent'])
-            / pd.Timedelta(days=1))
-
-    # Create a convenience column to aggregate referrals that are sent and not
-    # rejected, canceled, or closed without being seen
-    idx = ((~df['Date Referral Sent'].isna())
-           & (~df['Referral Status'].isin(['Rejected', 'Cancelled']))
-           & (~df['Referral Status'].isin(['Closed', 'Completed']) | (
-                ~df['Date Patient Seen or Checked In'].isna())))
-    df['Referral Aged Yn'] = 0
-    df.loc[idx, 'Referral Aged Yn'] = 1
-
-    # Create a convenience column to identify referrals that are either tagged as seen
-    # or the patient checked in to an appointment at the same clinic
-    idx = ~df['Date Patient Seen or Checked In'].isna()
-    df['Referral Seen or Checked In Yn'] = 0
-    df.loc[idx, 'Referral Seen or Checked In Yn'] = 1
-# END process_record_transforms
-
-
-def calculate_window_measures(df: pd.DataFrame, num_days: int) -> pd.DataFrame:
-    """Helper function to add rolling measures to given DataFrame across a given window size in days."""
-    window_name = f'{num_days}d'
-    measure_prefix = f'Moving {num_days}d '
-
-    measure_df = (
-        df.groupby(['Clinic'])
-        .rolling(window=window_name, on='Date')['# Aged'].sum()
-        .rename(measure_prefix + '# Aged')
-        .reset_index())
-    result_df = pd.merge(df, measure_df, how='left', on=['Clinic', 'Date'])
-
-    measure_df = (
-        df.groupby(['Clinic'])
-        .rolling(window=window_name, on='Date')['# Seen in 30d'].sum()
-        .rename(measure_prefix + '# Seen in 30d')
-        .reset_index())
-    result_df = pd.merge(result_df, measure_df, how='left', on=['Clinic', 'Date'])
-
-    result_df[measure_prefix + '% Seen in 30d'] = round(
-            result_df[measure_prefix + '# Seen in 30d']
-            / result_df[measure_prefix + '# Aged'], 3)
-
-    return result_df
-# END calculate_window_measures
-
-
-def calculate_rolling_measures(referrals_df: pd.DataFrame) -> tuple[pd.DataFrame, datetime, datetime]:
-    """Returns a DataFrame of rolling calendar window measures using the given DataFrame of referral data."""
-
-    # Create a measurement calendar and apply the referrals data to the calendar on the date that each
-    # referral reaches 30 days of age
-    start_dt, end_dt = get_measurement_dates(referrals_df)
-    calendar_df = create_calendar(start_dt, end_dt)
-    source_df = pd.merge(calendar_df, referrals_df, how='left', left_on=['Date'], right_on=['Date Referral Sent +31d'])
-
-    # Calculate count of referrals reaching 30 days of age on each calendar date
-    rolling_df = calendar_df.copy()
-    rolling_df['Clinic'] = '*ALL*'
-    count_by_date_df = (
-        source_df.groupby('Date')
-        .agg({'Referral Aged Yn': 'sum'})
-        .rename(columns={'Referral Aged Yn': '# Aged'}))
-    rolling_df = pd.merge(rolling_df, count_by_date_df, how='left', on='Date')
-
-    # Calculate count of referrals seen in 30 days by each calendar date
-    # All referrals wait 30 days before being measured for consistency, even if they are seen sooner
-    idx = (
-        (source_df['Referral Aged Yn'] == 1)
-        & (source_df['Referral Seen or Checked In Yn'] == 1)
-        & (source_df['Days until Patient Seen or Check In'] < 31))
-    count_by_date_df = (
-        source_df.loc[idx].groupby('Date')
-        .agg({'Referral Aged Yn': 'sum'})
-        .rename(columns={'Referral Aged Yn': '# Seen in 30d'}))
-    rolling_df = pd.merge(rolling_df, count_by_date_df, how='left', on='Date')
-
-    # Calculate count of referrals reaching 30 days of age on each calendar date broken out by clinic
-    count_by_date_df = (
-        source_df.groupby(['Clinic', 'Date'])
-        .agg({'Referral Aged Yn': 'sum'})
-        .rename(columns={'Referral Aged Yn': '# Aged'})
-        .reset_index())
-
-    # Calculate count of referrals seen in 30 days by each calendar date broken out by clinic
-    # All referrals wait 30 days before being measured for consistency, even if they are seen sooner
-    idx = (
-            (source_df['Referral Aged Yn'] == 1)
-            & (source_df['Referral Seen or Checked In Yn'] == 1)
-            & (source_df['Days until Patient Seen or Check In'] < 31))
-    count_by_date_2_df = (
-        source_df.loc[idx].groupby(['Clinic', 'Date'])
-        .agg({'Referral Aged Yn': 'sum'})
-        .rename(columns={'Referral Aged Yn': '# Seen in 30d'})
-        .reset_index())
-    count_by_date_df = pd.merge(count_by_date_df, count_by_date_2_df, how='left', on=['Clinic', 'Date'])
-
-    # Merge daily counts by clinic with the daily counts across all clinics into one dataframe
-    rolling_df = pd.merge(rolling_df,
-                          count_by_date_df,
-                          how='outer',
-                          on=['Clinic', 'Date', '# Aged', '# Seen in 30d']).fillna(0)
-    rolling_df['# Seen in 30d'] = rolling_df['# Seen in 30d'].astype(int)
-    rolling_df.sort_values(['Clinic', 'Date'], axis=0, inplace=True, ignore_index=True)
-
-    for days in [28, 91, 182, 364]:
-        rolling_df = calculate_window_measures(rolling_df, days)
-
-    return rolling_df, start_dt, end_dt
-# END calculate_rolling_measures
-
-
 def create_window_buttons(doc: Document,
                           upper_plot: MovingRatesPlot,
-                          lower_plot: MovingVolumesPlot) -> CheckboxButtonGroup:
+                          lower_plot: MovingVolumesPlot,
+                          active: list[int] = None) -> CheckboxButtonGroup:
     """Returns a group of buttons to hide or show the lines for each moving window in box plots."""
-    cb = CheckboxButtonGroup(labels=['28d', '91d', '182d', '364d'], active=[1, 3])
+    cb = CheckboxButtonGroup(labels=WINDOW_LABELS, active=[1, 3] if active is None else active)
     callback_code = """
         for (let i = 0; i < upper.length; i++) {
             upper[i].visible = false;
@@ -869,6 +565,67 @@ def create_window_buttons(doc: Document,
 # END create_window_buttons
 
 
+def get_session_state(doc: Document, clinics: list[str], first_dt: datetime, last_dt: datetime) -> dict:
+    """
+    Returns the view that a session starts on from the query arguments of the URL that opened it. Arguments that are
+    missing or not valid are left out so that the session starts on the default view for them. Each range is checked
+    on its own, clipped to the measures, and left out unless its start is before its end.
+
+    ?clinic=*ALL*&windows=91d,364d&start=2022-01-01&end=2022-12-31&ymin=0.2&ymax=0.8
+    """
+    if doc.session_context is None or doc.session_context.request is None:
+        return {}
+    arguments = {k: v[0].decode('utf-8') for k, v in doc.session_context.request.arguments.items() if v}
+
+    state = {}
+    if arguments.get('clinic') in clinics:
+        state['clinic'] = arguments['clinic']
+    if 'windows' in arguments:
+        windows = [w.strip().rstrip('d') + 'd' for w in arguments['windows'].split(',') if w.strip()]
+        if all(w in WINDOW_LABELS for w in windows):
+            state['windows'] = sorted({WINDOW_LABELS.index(w) for w in windows})
+    if 'start' in arguments and 'end' in arguments:
+        try:
+            start = max(pd.Timestamp(arguments['start']), pd.Timestamp(first_dt))
+            end = min(pd.Timestamp(arguments['end']), pd.Timestamp(last_dt))
+            if start < end:
+                state['x_range'] = (start, end)
+        except (ValueError, TypeError):
+            pass
+    if 'ymin' in arguments and 'ymax' in arguments:
+        try:
+            ymin = min(max(float(arguments['ymin']), 0.0), 1.0)
+            ymax = min(max(float(arguments['ymax']), 0.0), 1.0)
+            if ymin < ymax:
+                state['y_range'] = (ymin, ymax)
+        except ValueError:
+            pass
+    return state
+# END get_session_state
+
+
+def link_session_url(slicer: Select, cb: CheckboxButtonGroup, plot: figure) -> None:
+    """Keeps the query arguments of the page URL in step with the view so that the URL reopens the same view."""
+    callback = CustomJS(args=dict(slicer=slicer, group=cb, x_range=plot.x_range, y_range=plot.y_range),
+                        code="""
+                            const params = new URLSearchParams(window.location.search);
+                            const day = (ms) => new Date(ms).toISOString().slice(0, 10);
+                            params.set('clinic', slicer.value);
+                            params.set('windows', group.active.map((i) => group.labels[i]).join(','));
+                            params.set('start', day(x_range.start));
+                            params.set('end', day(x_range.end));
+                            params.set('ymin', y_range.start.toFixed(2));
+                            params.set('ymax', y_range.end.toFixed(2));
+                            window.history.replaceState(null, '', window.location.pathname + '?' + params);
+                        """)
+    slicer.js_on_change('value', callback)
+    cb.js_on_change('active', callback)
+    for model in [plot.x_range, plot.y_range]:
+        model.js_on_change('start', callback)
+        model.js_on_change('end', callback)
+# END link_session_url
+
+
 def link_line_mutes(upper_plot: MovingRatesPlot, lower_plot: MovingVolumesPlot) -> None:
     """Links the muted state of the lines in the moving rates plot and the moving volumes plot."""
     upper_plot_lines = upper_plot.get_lines()
@@ -906,9 +663,12 @@ def create_range_sliders(plots: list[figure]) -> tuple[ConnectedXDateRangeSlider
 # END create_range_sliders
 
 
-def create_shared_crosshair() -> CrosshairTool:
-    height_overlay = Span(dimension="height", line_dash="solid", line_width=1, line_color='black')
-    return CrosshairTool(overlay=height_overlay, toggleable=False)
+def create_trend_select(daily_plot: DailyVolumesPlot) -> Select:
+    """Returns a drop-down list of trend models that changes the trend line in the daily volumes plot."""
+    trend_select = Select(value='Linear', options=list(TREND_MODELS) + [VISIBLE_RANGE_TREND])
+    trend_select.on_change('value', lambda attr, old, new: daily_plot.set_trend_model(new))
+    return trend_select
+# END create_trend_select
 
 
 def add_layout(doc: Document,
@@ -918,9 +678,20 @@ def add_layout(doc: Document,
                x: DateRangeSlider,
                y: RangeSlider,
                slicer: Select,
-               cb: CheckboxButtonGroup) -> None:
+               cb: CheckboxButtonGroup,
+               compare_clinics: MultiChoice,
+               compare_window: Select,
+               trend: Select,
+               resolution: Select,
+               snapshot: DatePicker,
+               ranking: Select) -> None:
     """Adds Bokeh models to a page layout in the application document."""
     slicer_title = Div(text='Select a clinic', margin=(40, 5, 5, 5))
+    compare_title = Div(text='Compare clinics across one window size')
+    trend_title = Div(text='Trend of daily volume')
+    resolution_title = Div(text='Resolution of measures')
+    snapshot_title = Div(text='Measures as of date')
+    ranking_title = Div(text='Clinics with flagged drops and shifts in rate')
     cb_title = Div(text='Show or hide window sizes in chart')
     spacer = Div(text=' ', margin=(20, 5, 5, 5))
     spacer2 = Div(text=' ', margin=(20, 5, 5, 5))
@@ -928,7 +699,9 @@ def add_layout(doc: Document,
     upper_plot.height = 375
     middle_plot.height = 200
     lower_plot.height = 200
-    inputs = Column(slicer_title, slicer, cb_title, cb, spacer, x, y, spacer2, note)
+    inputs = Column(slicer_title, slicer, ranking_title, ranking, cb_title, cb,
+                    compare_title, compare_clinics, compare_window, trend_title, trend, resolution_title, resolution,
+                    snapshot_title, snapshot, spacer, x, y, spacer2, note)
     plots = Column(upper_plot, middle_plot, lower_plot)
     doc.add_root(Row(plots, inputs, width=800))
     doc.title = "Moving Process Rates"
@@ -937,24 +710,34 @@ def add_layout(doc: Document,
 
 # TOP-LEVEL
 
-print('loading referral data...')
-referral_df = load_data(DATA_FILE, COLUMN_TYPES, DATE_COLUMNS)
-print('processing record transforms...')
-process_record_transforms(referral_df)
-print('calculating rolling measures...')
-rolling_measures_df, first_measure_dt, last_measure_dt = calculate_rolling_measures(referral_df)
+rolling_measures_df, first_measure_dt, last_measure_dt = get_rolling_measures(DATA_FILE)
+session_state = get_session_state(curdoc(), rolling_measures_df['Clinic'].unique().tolist(), first_measure_dt,
+                                  last_measure_dt)
+initial_clinic = session_state.get('clinic', '*ALL*')
 
 print('adding Bokeh plots...')
-shared_crosshair = create_shared_crosshair()
-rates_plot = MovingRatesPlot(rolling_measures_df, first_measure_dt, shared_crosshair)
-volumes_plot = MovingVolumesPlot(rolling_measures_df, first_measure_dt, shared_crosshair)
-daily_plot = DailyVolumesPlot(rolling_measures_df, first_measure_dt, shared_crosshair)
+with stage_timer('create_plots') as plots_stage:
+    shared_crosshair = create_shared_crosshair()
+    rates_plot = MovingRatesPlot(rolling_measures_df, first_measure_dt, shared_crosshair, initial_clinic,
+                                 get_view_data(MovingRatesPlot, initial_clinic, 'Daily', None))
+    volumes_plot = MovingVolumesPlot(rolling_measures_df, first_measure_dt, shared_crosshair, initial_clinic,
+                                     get_view_data(MovingVolumesPlot, initial_clinic, 'Daily', None))
+    daily_plot = DailyVolumesPlot(rolling_measures_df, first_measure_dt, shared_crosshair, initial_clinic,
+                                  get_view_data(DailyVolumesPlot, initial_clinic, 'Daily', None))
+    plots_stage.rows = len(rolling_measures_df)
 x_range_slider, y_range_slider = create_range_sliders([rates_plot.get_figure(),
                                                        volumes_plot.get_figure(),
                                                        daily_plot.get_figure()])
-clinic_slicer = ClinicSlicer([rates_plot, volumes_plot, daily_plot], rolling_measures_df)
-window_buttons = create_window_buttons(curdoc(), rates_plot, volumes_plot)
+clinic_slicer = ClinicSlicer([rates_plot, volumes_plot, daily_plot], rolling_measures_df, initial_clinic)
+clinic_comparison = ClinicComparison(rates_plot, rolling_measures_df)
+resolution_selector = ResolutionSelector(clinic_slicer, rates_plot.get_figure())
+anomaly_flags = AnomalyFlags(rates_plot, clinic_slicer, get_rate_anomalies(DATA_FILE),
+                             get_complete_measures_date(last_measure_dt))
+snapshot_selector = SnapshotSelector(clinic_slicer, clinic_comparison, anomaly_flags, first_measure_dt,
+                                     last_measure_dt)
+window_buttons = create_window_buttons(curdoc(), rates_plot, volumes_plot, session_state.get('windows'))
 link_line_mutes(rates_plot, volumes_plot)
+trend_select = create_trend_select(daily_plot)
 add_layout(curdoc(),
            rates_plot.get_figure(),
            volumes_plot.get_figure(),
@@ -962,4 +745,15 @@ add_layout(curdoc(),
            x_range_slider.get_slider_model(),
            y_range_slider.get_slider_model(),
            clinic_slicer.get_slicer_model(),
-           window_buttons)
+           window_buttons,
+           clinic_comparison.get_clinics_model(),
+           clinic_comparison.get_window_model(),
+           trend_select,
+           resolution_selector.get_selector_model(),
+           snapshot_selector.get_picker_model(),
+           anomaly_flags.get_ranking_model())
+if 'x_range' in session_state:
+    x_range_slider.get_slider_model().value = session_state['x_range']
+if 'y_range' in session_state:
+    y_range_slider.get_slider_model().value = session_state['y_range']
+link_session_url(clinic_slicer.get_slicer_model(), window_buttons, rates_plot.get_figure())
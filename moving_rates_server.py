@@ -0,0 +1,66 @@
+"""
+Starts a Bokeh server that runs the moving process rates application together with the read-only rolling measures
+endpoint on the same Tornado server.
+
+usage: python moving_rates_server.py [--port 5006] [--allow-websocket-origin HOST[:PORT] ...]
+                                     [--metrics-log-interval SECONDS] [--prewarm-clinics 20] [--show]
+"""
+
+import argparse
+import os
+
+from bokeh.application import Application
+from bokeh.application.handlers import ScriptHandler
+from bokeh.server.server import Server
+from bokeh.util.logconfig import basicConfig
+
+from tornado.ioloop import PeriodicCallback
+
+from pipeline_metrics import MetricsHandler, log_metrics
+from rolling_measures_api import RollingMeasuresHandler
+from view_cache import prewarm_view_cache
+
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'moving-process-rates.py')
+
+
+def create_server(port: int = 5006, allow_websocket_origin: list[str] = None) -> Server:
+    """Returns a Bokeh server with the moving process rates application and the rolling measures endpoint."""
+    app = Application(ScriptHandler(filename=APP_FILE))
+    return Server({'/moving-process-rates': app},
+                  port=port,
+                  allow_websocket_origin=allow_websocket_origin or [f'localhost:{port}'],
+                  extra_patterns=[(r'/rolling-measures', RollingMeasuresHandler),
+                                  (r'/metrics', MetricsHandler)])
+# END create_server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve the moving process rates application and data endpoint.')
+    parser.add_argument('--port', type=int, default=5006, help='port to listen on')
+    parser.add_argument('--allow-websocket-origin', action='append', help='host that may connect to the application')
+    parser.add_argument('--metrics-log-interval', type=float, default=0,
+                        help='seconds between metrics written to the log, or 0 to not log them')
+    parser.add_argument('--prewarm-clinics', type=int, default=20,
+                        help='number of the busiest clinics whose views are prepared before the server starts')
+    parser.add_argument('--show', action='store_true', help='open the application in a browser')
+    args = parser.parse_args()
+    basicConfig(level='INFO')
+    if args.prewarm_clinics > 0:
+        prewarm_view_cache(args.prewarm_clinics)
+
+    server = create_server(args.port, args.allow_websocket_origin)
+    server.start()
+    print(f'Bokeh app running at: http://localhost:{args.port}/moving-process-rates')
+    print(f'Rolling measures at: http://localhost:{args.port}/rolling-measures')
+    print(f'Metrics at: http://localhost:{args.port}/metrics')
+    if args.metrics_log_interval > 0:
+        PeriodicCallback(log_metrics, args.metrics_log_interval * 1000.0).start()
+    if args.show:
+        server.io_loop.add_callback(server.show, '/moving-process-rates')
+    server.io_loop.start()
+# END main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Records the wall time, peak resident memory growth, and row counts of each stage of the moving rates pipeline along with
+latency histograms of the interactive callbacks. The measurements are kept for the life of the server process and can
+be served by the metrics endpoint or written to the log periodically.
+"""
+
+import json
+import logging
+import sys
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+from tornado.web import RequestHandler
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the callback latency histogram buckets in milliseconds
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+_stages = {}
+_callbacks = {}
+
+
+class StageRecord:
+    """The measurements of one run of a pipeline stage."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.rows = None
+        self.seconds = None
+        self.peak_rss_delta_kb = None
+
+    def to_dict(self) -> dict:
+        return {'seconds': self.seconds, 'peak_rss_delta_kb': self.peak_rss_delta_kb, 'rows': self.rows}
+# END CLASS StageRecord
+
+
+class LatencyHistogram:
+    """Counts callback latencies into fixed buckets and keeps the total and maximum latency."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(LATENCY_BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms: float) -> None:
+        """Adds one latency measurement in milliseconds to the histogram."""
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        """Returns the upper bound of the bucket that contains the given percentile of latencies."""
+        target = q / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= target and seen > 0:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        return {'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count else None,
+                'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95),
+                'p99_ms': self.percentile(99),
+                'max_ms': self.max_ms,
+                'buckets': {str(b): n for b, n in zip(LATENCY_BUCKETS_MS, self.counts)}}
+# END CLASS LatencyHistogram
+
+
+def get_peak_rss_kb() -> int:
+    """Returns the peak resident set size of this process in kilobytes, or None where it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes where Linux reports kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+# END get_peak_rss_kb
+
+
+def get_current_rss_kb() -> int:
+    """Returns the current resident set size of this process in kilobytes, or None where it cannot be measured."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, AttributeError):
+        return None
+# END get_current_rss_kb
+
+
+@contextmanager
+def stage_timer(name: str):
+    """
+    Measures a pipeline stage run within the context. The yielded record accepts a row count for the stage.
+
+    with stage_timer('load_data') as stage:
+        df = load_data(...)
+        stage.rows = len(df)
+    """
+    record = StageRecord(name)
+    rss_before = get_peak_rss_kb()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        rss_after = get_peak_rss_kb()
+        if rss_before is not None:
+            record.peak_rss_delta_kb = rss_after - rss_before
+        _stages[name] = record
+        log.info('stage %s took %.3fs, peak RSS +%s KB, %s rows',
+                 name, record.seconds, record.peak_rss_delta_kb, record.rows)
+# END stage_timer
+
+
+def timed_callback(name: str):
+    """Returns a decorator that adds the latency of each call of a Bokeh callback to the histogram of the given name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _callbacks.setdefault(name, LatencyHistogram()).add((time.perf_counter() - start) * 1000.0)
+        return wrapper
+    return decorator
+# END timed_callback
+
+
+def get_metrics() -> dict:
+    """Returns a snapshot of the latest stage measurements and the callback latency histograms."""
+    return {'stages': {name: record.to_dict() for name, record in _stages.items()},
+            'callbacks': {name: histogram.to_dict() for name, histogram in _callbacks.items()},
+            'peak_rss_kb': get_peak_rss_kb(),
+            'rss_kb': get_current_rss_kb()}
+
+
+def log_metrics() -> None:
+    """Writes a snapshot of the metrics to the log as one line of JSON."""
+    log.info('metrics %s', json.dumps(get_metrics()))
+
+
+class MetricsHandler(RequestHandler):
+    """Tornado request handler that serves a snapshot of the metrics as JSON."""
+
+    def get(self) -> None:
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-store')
+        self.write(json.dumps(get_metrics()))
+# END CLASS MetricsHandler
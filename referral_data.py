@@ -0,0 +1,896 @@
+"""
+Loads referral data and calculates the moving rate measures that are plotted by the moving process rates application.
+
+Python module imports happen once and are then cached, so the rolling measures calculated by this module are shared by
+every session of the Bokeh application that is started by the same server process.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+from contextlib import closing
+from functools import cache, lru_cache, partial
+
+import numpy as np
+
+import pandas as pd
+
+from datetime import datetime
+
+from numpy import ndarray
+
+from pipeline_metrics import stage_timer
+
+
+DATE_COLUMNS = ['Date Referral Sent',
+                'Date Referral Seen',
+                'Date Patient Checked In',
+                'Date Held',
+                'Date Pending Reschedule',
+                'Date Last Referral Update',
+                'Date Similar Appt Scheduled',
+                'Date Accepted',
+                'Date Referral Written',
+                'Date Referral Completed',
+                'Date Referral Scheduled']
+
+COLUMN_TYPES = {
+    'Referral ID': 'string',
+    'Source Location': 'string',
+    'Provider Referred To': 'string',
+    'Location Referred To': 'string',
+    'Referral Priority': 'string',
+    'Referral Status': 'string',
+    'Patient ID': 'string',
+    'Clinic': 'string',
+    'Last Referral Update By': 'string',
+    'Assigned Personnel': 'string',
+    'Organization Referred To': 'string',
+    'Reason for Hold': 'string',
+    'Referral Sub-Status': 'string',
+    'Date Referral Sent': 'object',
+    'Date Referral Seen': 'object',
+    'Date Patient Checked In': 'object',
+    'Date Held': 'object',
+    'Date Pending Reschedule': 'object',
+    'Date Last Referral Update': 'object',
+    'Date Similar Appt Scheduled': 'object',
+    'Date Accepted': 'object',
+    'Date Referral Written': 'object',
+    'Date Referral Completed': 'object',
+    'Date Referral Scheduled': 'object'}
+
+# The referral extract can be replaced, for example with synthetic data, by setting an environment variable
+DATA_FILE = os.environ.get('REFERRALS_DATA_FILE', 'referrals.csv')
+AS_OF_DATE = datetime(2023, 3, 1)
+
+# Measures follow a business-day calendar when a file of holidays is given, which may be empty for weekends alone
+HOLIDAYS_FILE = os.environ.get('REFERRALS_HOLIDAYS_FILE')
+
+# The number of as-of snapshots whose measures are kept for stepping back and forth between recent snapshot dates
+SNAPSHOT_CACHE_SIZE = 16
+
+
+def load_data(file_path: str, columns: dict[str, str], date_columns: list[str]) -> pd.DataFrame:
+    """
+    Extracts referral data from a text file and returns a DataFrame.
+    :param file_path: The path to the file with the referral data
+    :param columns: The names and intended data types of each column in the file
+    :param date_columns: The names of the columns to be typecast as datetime
+    :return: A dataframe of referral data
+    """
+    df = pd.read_csv(file_path, header=0, dtype=columns)
+    # This seems to work better than asking read_csv to convert datetime columns
+    df[date_columns] = df[date_columns].apply(pd.to_datetime)
+    return df
+# END load_data
+
+
+def get_measurement_dates(df: pd.DataFrame) -> tuple[datetime, datetime]:
+    """Returns a tuple with the first and last measurement dates from the given DataFrame of referral data."""
+    start_dt = min(df['Date Referral Sent +31d'])
+    end_dt = max(df['Date Referral Sent +31d'])
+    return start_dt, end_dt
+# END get_measurement_dates
+
+
+def create_calendar(start_dt: datetime, end_dt: datetime) -> pd.DataFrame:
+    """Returns a DataFrame with all calendar dates across a given range of dates."""
+    return pd.DataFrame({'Date': pd.date_range(start_dt, end_dt)})
+
+
+def load_holidays(file_path: str) -> pd.DatetimeIndex:
+    """Returns the holiday dates from a text file with a Date column and one row per holiday."""
+    holiday_df = pd.read_csv(file_path, header=0, dtype={'Date': 'object'})
+    return pd.DatetimeIndex(pd.to_datetime(holiday_df['Date'])).normalize().unique().sort_values()
+# END load_holidays
+
+
+def create_business_calendar(start_dt: datetime, end_dt: datetime, holidays: pd.DatetimeIndex) -> pd.DatetimeIndex:
+    """Returns the working days, Monday through Friday except for the given holidays, across a given range of dates."""
+    return pd.bdate_range(start_dt, end_dt, freq='C', holidays=list(holidays))
+
+
+def process_record_transforms(df: pd.DataFrame) -> None:
+    """Adds columns of record specific measurements to the given DataFrame of referral data."""
+
+    # Create an offset date when the referral reached 30 days of age
+    df['Date Referral Sent +31d'] = df['Date Referral Sent'] + pd.Timedelta(days=31)
+    df['As Of Date'] = AS_OF_DATE
+
+    # Days until the referral tagged as seen or patient checked into clinic appointment
+    df['Date Patient Seen or Checked In'] = df['Date Referral Seen']
+    idx = df['Date Patient Seen or Checked In'].isna()
+    df.loc[idx, 'Date Patient Seen or Checked In'] = df.loc[idx, 'Date Patient Checked In']
+    df['Days until Patient Seen or Check In'] = (
+            (df['Date Patient Seen or Checked In'] -
+             df['Date Referral Sent']) / pd.Timedelta(days=1))
+    idx = df['Date Patient Seen or Checked In'].isna()
+    df.loc[idx, 'Days until Patient Seen or Check In'] = (
+            (df.loc[idx, 'As Of Date'] - df.loc[idx, 'Date Referral Sent'])
+            / pd.Timedelta(days=1))
+
+    # Create a convenience column to aggregate referrals that are sent and not
+    # rejected, canceled, or closed without being seen
+    idx = ((~df['Date Referral Sent'].isna())
+           & (~df['Referral Status'].isin(['Rejected', 'Cancelled']))
+           & (~df['Referral Status'].isin(['Closed', 'Completed']) | (
+                ~df['Date Patient Seen or Checked In'].isna())))
+    df['Referral Aged Yn'] = 0
+    df.loc[idx, 'Referral Aged Yn'] = 1
+
+    # Create a convenience column to identify referrals that are either tagged as seen
+    # or the patient checked in to an appointment at the same clinic
+    idx = ~df['Date Patient Seen or Checked In'].isna()
+    df['Referral Seen or Checked In Yn'] = 0
+    df.loc[idx, 'Referral Seen or Checked In Yn'] = 1
+# END process_record_transforms
+
+
+def calculate_window_measures(df: pd.DataFrame, num_days: int) -> pd.DataFrame:
+    """Helper function to add rolling measures to given DataFrame across a given window size in days."""
+    window_name = f'{num_days}d'
+    measure_prefix = f'Moving {num_days}d '
+
+    measure_df = (
+        df.groupby(['Clinic'])
+        .rolling(window=window_name, on='Date')['# Aged'].sum()
+        .rename(measure_prefix + '# Aged')
+        .reset_index())
+    result_df = pd.merge(df, measure_df, how='left', on=['Clinic', 'Date'])
+
+    measure_df = (
+        df.groupby(['Clinic'])
+        .rolling(window=window_name, on='Date')['# Seen in 30d'].sum()
+        .rename(measure_prefix + '# Seen in 30d')
+        .reset_index())
+    result_df = pd.merge(result_df, measure_df, how='left', on=['Clinic', 'Date'])
+
+    result_df[measure_prefix + '% Seen in 30d'] = round(
+            result_df[measure_prefix + '# Seen in 30d']
+            / result_df[measure_prefix + '# Aged'], 3)
+
+    return result_df
+# END calculate_window_measures
+
+
+def calculate_daily_counts(referrals_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns a DataFrame with the count of referrals reaching 30 days of age and the count of those referrals seen in
+    30 days, by clinic and by the date that the referrals reached 30 days of age. Referrals without a clinic are
+    counted in a group with a missing clinic name so that they are still part of the counts across all clinics.
+    """
+
+    # All referrals wait 30 days before being measured for consistency, even if they are seen sooner
+    idx = (
+        (referrals_df['Referral Aged Yn'] == 1)
+        & (referrals_df['Referral Seen or Checked In Yn'] == 1)
+        & (referrals_df['Days until Patient Seen or Check In'] < 31))
+    count_df = pd.DataFrame({
+        'Clinic': referrals_df['Clinic'],
+        'Date': referrals_df['Date Referral Sent +31d'],
+        '# Aged': referrals_df['Referral Aged Yn'],
+        '# Seen in 30d': idx.astype(int)})
+    count_df = count_df.loc[~count_df['Date'].isna()]
+
+    return (
+        count_df.groupby(['Clinic', 'Date'], dropna=False)
+        .agg({'# Aged': 'sum', '# Seen in 30d': 'sum'})
+        .reset_index())
+# END calculate_daily_counts
+
+
+def calculate_business_day_measures(count_df: pd.DataFrame,
+                                    start_dt: datetime,
+                                    end_dt: datetime,
+                                    holidays: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    Returns a DataFrame of rolling working day window measures using the given DataFrame of daily counts by clinic.
+    Referrals that reach 30 days of age on a weekend or holiday are counted on the next working day. Each window spans
+    the working days of the same number of weeks, so the 28d window is 20 working days whatever holidays fall in it.
+    Windows are differences of prefix sums over a clinic by working day matrix, with the working days as its index.
+    :param count_df: Daily counts of referrals by clinic and measurement date as returned by calculate_daily_counts
+    :param start_dt: The first measurement date
+    :param end_dt: The last measurement date
+    :param holidays: The dates that are not working days in addition to weekends
+    :return: A DataFrame with the same columns as calculate_rolling_measures_from_counts on working days only
+    """
+
+    # The calendar runs past the last date so that counts on a final weekend or holiday have a working day to move to
+    workdays = create_business_calendar(start_dt, pd.Timestamp(end_dt) + pd.Timedelta(days=14), holidays)
+    day_codes = workdays.searchsorted(count_df['Date'].to_numpy())
+    workdays = workdays[:day_codes.max() + 1]
+
+    # Row zero of each matrix holds the counts across all clinics, which include the referrals without a clinic
+    clinic_codes, clinics = pd.factorize(count_df['Clinic'])
+    shape = (len(clinics) + 1, len(workdays))
+    is_clinic = clinic_codes >= 0
+    rows = clinic_codes[is_clinic] + 1
+    days = day_codes[is_clinic]
+    matrices = {}
+    for column in ['# Aged', '# Seen in 30d']:
+        counts = count_df[column].to_numpy(dtype=float)
+        matrix = np.zeros(shape)
+        np.add.at(matrix, (rows, days), counts[is_clinic])
+        matrix[0] = np.bincount(day_codes, weights=counts, minlength=shape[1])
+        matrices[column] = matrix
+    has_row = np.zeros(shape, dtype=bool)
+    has_row[rows, days] = True
+    has_row[0] = True
+
+    # Rows are kept on every working day across all clinics and on the working days with counts for each clinic
+    row_idx, day_idx = np.nonzero(has_row)
+    rolling_df = pd.DataFrame({
+        'Date': workdays[day_idx],
+        'Clinic': np.append('*ALL*', clinics.to_numpy(dtype=object))[row_idx],
+        '# Aged': matrices['# Aged'][row_idx, day_idx].astype(int),
+        '# Seen in 30d': matrices['# Seen in 30d'][row_idx, day_idx].astype(int)})
+
+    # The prefix sums start with a column of zeros so that a window starting on the first working day subtracts zero
+    prefix_sums = {column: np.pad(np.cumsum(matrix, axis=1), ((0, 0), (1, 0))) for column, matrix in matrices.items()}
+    for num_days in [28, 91, 182, 364]:
+        measure_prefix = f'Moving {num_days}d '
+        window_starts = np.maximum(np.arange(shape[1]) + 1 - num_days * 5 // 7, 0)
+        for column, column_sums in prefix_sums.items():
+            window_sums = column_sums[:, 1:] - column_sums[:, window_starts]
+            rolling_df[measure_prefix + column] = window_sums[row_idx, day_idx]
+        rolling_df[measure_prefix + '% Seen in 30d'] = round(
+                rolling_df[measure_prefix + '# Seen in 30d']
+                / rolling_df[measure_prefix + '# Aged'], 3)
+
+    return rolling_df.sort_values(['Clinic', 'Date'], ignore_index=True)
+# END calculate_business_day_measures
+
+
+def calculate_rolling_measures_from_counts(count_df: pd.DataFrame,
+                                           start_dt: datetime,
+                                           end_dt: datetime,
+                                           holidays: pd.DatetimeIndex = None) -> pd.DataFrame:
+    """
+    Returns a DataFrame of rolling calendar window measures using the given DataFrame of daily counts by clinic.
+    :param count_df: Daily counts of referrals by clinic and measurement date as returned by calculate_daily_counts
+    :param start_dt: The first measurement date
+    :param end_dt: The last measurement date
+    :param holidays: The holidays of a business-day calendar, or None for rolling windows of calendar days
+    :return: A DataFrame with the daily counts and rolling measures across all clinics and for each clinic
+    """
+    if holidays is not None:
+        return calculate_business_day_measures(count_df, start_dt, end_dt, holidays)
+
+    # Calculate counts across all clinics on every date in a measurement calendar
+    calendar_df = create_calendar(start_dt, end_dt)
+    all_df = count_df.groupby('Date').agg({'# Aged': 'sum', '# Seen in 30d': 'sum'}).reset_index()
+    all_df = pd.merge(calendar_df, all_df, how='left', on='Date').fillna(0)
+    all_df.insert(1, 'Clinic', '*ALL*')
+
+    # Merge daily counts by clinic with the daily counts across all clinics into one dataframe
+    clinic_df = count_df.loc[~count_df['Clinic'].isna(), ['Date', 'Clinic', '# Aged', '# Seen in 30d']]
+    rolling_df = pd.concat([all_df, clinic_df], ignore_index=True)
+    rolling_df['Clinic'] = rolling_df['Clinic'].astype(object)
+    rolling_df['# Aged'] = rolling_df['# Aged'].astype(int)
+    rolling_df['# Seen in 30d'] = rolling_df['# Seen in 30d'].astype(int)
+    rolling_df.sort_values(['Clinic', 'Date'], axis=0, inplace=True, ignore_index=True)
+
+    for days in [28, 91, 182, 364]:
+        rolling_df = calculate_window_measures(rolling_df, days)
+
+    return rolling_df
+# END calculate_rolling_measures_from_counts
+
+
+def calculate_rolling_measures(referrals_df: pd.DataFrame,
+                               holidays: pd.DatetimeIndex = None) -> tuple[pd.DataFrame, datetime, datetime]:
+    """Returns a DataFrame of rolling calendar window measures using the given DataFrame of referral data."""
+
+    # Referrals are counted on the calendar date that each referral reaches 30 days of age
+    start_dt, end_dt = get_measurement_dates(referrals_df)
+    count_df = calculate_daily_counts(referrals_df)
+    return calculate_rolling_measures_from_counts(count_df, start_dt, end_dt, holidays), start_dt, end_dt
+# END calculate_rolling_measures
+
+
+def calculate_referral_offsets(referrals_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.Index, datetime]:
+    """
+    Returns the per-referral day offsets that as-of snapshots are counted from, along with the clinic names of the
+    clinic codes and the date of day offset zero. Offsets are days since the first date a referral was sent.
+    Referrals without a clinic have the code after the last clinic so that they are still part of the counts across
+    all clinics.
+    :param referrals_df: Referral data with the columns added by process_record_transforms
+    :return: A tuple of a DataFrame of offsets with one row per sent referral, the clinic names, and the first date
+    """
+    sent_df = referrals_df.loc[~referrals_df['Date Referral Sent'].isna()]
+    first_dt = sent_df['Date Referral Sent'].min().normalize()
+    clinic_codes, clinics = pd.factorize(sent_df['Clinic'])
+    clinic_codes[clinic_codes < 0] = len(clinics)
+
+    # A referral closed without being seen is not aged, so whether it is aged depends on the snapshot of its seen date
+    offset_df = pd.DataFrame({
+        'Clinic Code': clinic_codes,
+        'Sent Day': ((sent_df['Date Referral Sent'] - first_dt) / pd.Timedelta(days=1)).to_numpy(),
+        'Seen Day': ((sent_df['Date Patient Seen or Checked In'] - first_dt) / pd.Timedelta(days=1)).to_numpy(),
+        'Aged If Seen': ~sent_df['Referral Status'].isin(['Rejected', 'Cancelled']).to_numpy(dtype=bool),
+        'Aged If Not Seen': ~sent_df['Referral Status'].isin(['Rejected', 'Cancelled', 'Closed', 'Completed'])
+                            .to_numpy(dtype=bool)})
+    return offset_df, clinics, first_dt
+# END calculate_referral_offsets
+
+
+def calculate_snapshot_counts(offset_df: pd.DataFrame,
+                              clinics: pd.Index,
+                              first_dt: datetime,
+                              snapshot_dt: datetime) -> pd.DataFrame:
+    """
+    Returns the daily counts by clinic as they would have been counted on a past date. Referrals sent after that date
+    are not counted, seen dates after it are ignored, and measurement dates after it are left out. Every referral is
+    counted in one pass of masks and bin counts over the day offsets.
+    :param offset_df: Per-referral day offsets as returned by calculate_referral_offsets
+    :param clinics: The clinic names of the clinic codes
+    :param first_dt: The date of day offset zero
+    :param snapshot_dt: The date the snapshot is taken
+    :return: A DataFrame of daily counts as returned by calculate_daily_counts
+    """
+    snapshot_day = (pd.Timestamp(snapshot_dt) - first_dt) / pd.Timedelta(days=1)
+    sent_day = offset_df['Sent Day'].to_numpy()
+    seen_day = offset_df['Seen Day'].to_numpy()
+
+    # Comparisons with the missing seen day of a referral that was never seen are false
+    is_seen = seen_day <= snapshot_day
+    is_aged = np.where(is_seen, offset_df['Aged If Seen'].to_numpy(), offset_df['Aged If Not Seen'].to_numpy())
+    is_seen_in_30d = is_aged & is_seen & (seen_day - sent_day < 31)
+
+    # Referrals are counted on the day that they reach 30 days of age, if that day has passed by the snapshot
+    measure_day = np.floor(sent_day).astype(int) + 31
+    idx = measure_day <= snapshot_day
+    num_days = max(int(measure_day.max()) + 1, 1) if len(measure_day) else 1
+    bins = offset_df['Clinic Code'].to_numpy()[idx] * num_days + measure_day[idx]
+    num_bins = (len(clinics) + 1) * num_days
+    referrals = np.bincount(bins, minlength=num_bins)
+    aged = np.bincount(bins, weights=is_aged[idx], minlength=num_bins)
+    seen_in_30d = np.bincount(bins, weights=is_seen_in_30d[idx], minlength=num_bins)
+
+    # Only the clinic and date groups with a referral are returned, as a group by of the referrals would return them
+    counted = np.flatnonzero(referrals)
+    clinic_names = np.append(clinics.to_numpy(dtype=object), pd.NA)
+    return pd.DataFrame({
+        'Clinic': pd.array(clinic_names[counted // num_days], dtype='string'),
+        'Date': first_dt + pd.to_timedelta(counted % num_days, unit='D'),
+        '# Aged': aged[counted].astype(int),
+        '# Seen in 30d': seen_in_30d[counted].astype(int)})
+# END calculate_snapshot_counts
+
+
+TREND_MODELS = {
+    'Linear': 'Trend Linear',
+    'Robust': 'Trend Robust',
+    'Seasonal': 'Trend Seasonal'}
+
+
+def create_trend_design(days: ndarray, model: str) -> ndarray:
+    """Returns a matrix of regressors with one row per day offset for the given trend model."""
+    columns = [np.ones(len(days)), days]
+    if model == 'Seasonal':
+        # Weekly and yearly harmonics capture the clinic week and the seasons without a regressor per weekday
+        for period in [7.0, 365.25]:
+            columns.append(np.sin(2.0 * np.pi * days / period))
+            columns.append(np.cos(2.0 * np.pi * days / period))
+    return np.column_stack(columns)
+# END create_trend_design
+
+
+def solve_batched_least_squares(design: ndarray, y: ndarray, weights: ndarray) -> ndarray:
+    """
+    Returns the weighted least squares coefficients for every row of a clinic by date matrix in one batched solve.
+    :param design: The regressors with one row per date and one column per coefficient
+    :param y: The observed values with one row per clinic and one column per date
+    :param weights: The weight of each observation, zero where a clinic has no observation on a date
+    :return: A matrix of coefficients with one row per clinic
+    """
+    xtx = np.einsum('cd,di,dj->cij', weights, design, design)
+    xty = np.einsum('cd,di->ci', weights * y, design)
+    # The pseudo-inverse keeps clinics with too few observations from failing the whole batch
+    return np.einsum('cij,cj->ci', np.linalg.pinv(xtx), xty)
+# END solve_batched_least_squares
+
+
+def calculate_trend_fits(rolling_df: pd.DataFrame, robust_iterations: int = 10) -> pd.DataFrame:
+    """
+    Adds a column of fitted daily volumes for each of the trend models to the given DataFrame of rolling measures.
+    Every clinic is fitted at once from a clinic by date matrix of daily volumes.
+    """
+    clinic_codes, clinics = pd.factorize(rolling_df['Clinic'])
+    first_dt = rolling_df['Date'].min()
+    day_codes = ((rolling_df['Date'] - first_dt) / pd.Timedelta(days=1)).astype(int).to_numpy()
+    days = np.arange(day_codes.max() + 1, dtype=float)
+
+    # Only the dates that exist for a clinic are observations, matching a fit of that clinic's rows alone
+    y = np.zeros((len(clinics), len(days)))
+    observed = np.zeros((len(clinics), len(days)))
+    y[clinic_codes, day_codes] = rolling_df['# Aged'].to_numpy(dtype=float)
+    observed[clinic_codes, day_codes] = 1.0
+
+    linear_design = create_trend_design(days, 'Linear')
+    coefficients = solve_batched_least_squares(linear_design, y, observed)
+    fits = {'Linear': coefficients @ linear_design.T}
+
+    # Huber weights from iteratively reweighted least squares discount outlying days such as clinic closures
+    weights = observed
+    for _ in range(robust_iterations):
+        residuals = np.where(observed > 0, y - coefficients @ linear_design.T, np.nan)
+        scale = 1.4826 * np.nanmedian(np.abs(residuals), axis=1, keepdims=True)
+        threshold = 1.345 * np.where(scale > 0, scale, 1.0)
+        weights = observed * np.minimum(1.0, threshold / np.maximum(np.abs(np.nan_to_num(residuals)), 1e-12))
+        coefficients = solve_batched_least_squares(linear_design, y, weights)
+    fits['Robust'] = coefficients @ linear_design.T
+
+    seasonal_design = create_trend_design(days, 'Seasonal')
+    coefficients = solve_batched_least_squares(seasonal_design, y, observed)
+    fits['Seasonal'] = coefficients @ seasonal_design.T
+
+    for model, column in TREND_MODELS.items():
+        rolling_df[column] = fits[model][clinic_codes, day_codes]
+
+    return rolling_df
+# END calculate_trend_fits
+
+
+RESOLUTIONS = {
+    'Daily': None,
+    'Weekly': 'W',
+    'Monthly': 'ME'}
+
+
+def calculate_resolution_pyramid(rolling_df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """
+    Returns the rolling measures at each resolution, from the daily measures to weekly and monthly rollups that have the
+    same columns. Daily counts and trend fits are totalled over each period and the moving measures are taken from the
+    last day of each period. Periods are labelled with their last date.
+    """
+    pyramid = {'Daily': rolling_df}
+    sum_columns = ['# Aged', '# Seen in 30d'] + [c for c in rolling_df.columns if c.startswith('Trend ')]
+    last_columns = [c for c in rolling_df.columns if c.startswith('Moving ')]
+    aggregations = {c: 'sum' for c in sum_columns} | {c: 'last' for c in last_columns}
+    for level, freq in RESOLUTIONS.items():
+        if freq is None:
+            continue
+        level_df = (
+            rolling_df.groupby(['Clinic', pd.Grouper(key='Date', freq=freq)])
+            .agg(aggregations)
+            .reset_index())
+        pyramid[level] = level_df[rolling_df.columns]
+    return pyramid
+# END calculate_resolution_pyramid
+
+
+def create_clinic_matrix(rolling_df: pd.DataFrame,
+                         column: str,
+                         clinic_codes: ndarray,
+                         day_codes: ndarray,
+                         shape: tuple[int, int],
+                         fill: str) -> ndarray:
+    """
+    Returns a clinic by date matrix of one column of the rolling measures. Dates without a row for a clinic are either
+    zero, for daily counts, or carry the last measure forward, for moving measures.
+    """
+    matrix = np.full(shape, np.nan)
+    matrix[clinic_codes, day_codes] = rolling_df[column].to_numpy(dtype=float)
+    if fill == 'zero':
+        return np.nan_to_num(matrix)
+    return pd.DataFrame(matrix).ffill(axis=1).to_numpy()
+# END create_clinic_matrix
+
+
+def calculate_rate_anomalies(rolling_df: pd.DataFrame,
+                             cutoff_dt: datetime = None,
+                             z_threshold: float = 3.0,
+                             cusum_slack: float = 0.5,
+                             cusum_threshold: float = 5.0,
+                             min_aged: int = 20) -> pd.DataFrame:
+    """
+    Returns the dates where the rate that referrals are seen in 30 days dropped for each clinic. Every clinic is scanned
+    at once from clinic by date matrices of the daily counts and the moving measures.
+
+    A drop is the first day that the moving 28d rate is more than z_threshold standard errors below the 364d baseline
+    as it was before those 28 days. A shift is a level shift found by a lower CUSUM of the daily counts standardized
+    against the same baseline, flagged where the sum passes cusum_threshold and then restarted. Nothing is flagged
+    after the cutoff date, where referrals have not all had their full 30 days to be seen.
+    :param rolling_df: The daily counts and rolling measures as returned by calculate_rolling_measures
+    :param cutoff_dt: The last measurement date that is scanned, or None to scan every date
+    :param z_threshold: The number of standard errors below the baseline that flags a drop
+    :param cusum_slack: The standardized shortfall per day that is allowed before it adds to the CUSUM
+    :param cusum_threshold: The CUSUM that flags a shift
+    :param min_aged: The least referrals in the moving 28d window for a drop to be flagged
+    :return: A DataFrame of flags with the clinic, date, kind of flag, score, and moving 28d rate on that date
+    """
+    clinic_codes, clinics = pd.factorize(rolling_df['Clinic'])
+    first_dt = rolling_df['Date'].min()
+    day_codes = ((rolling_df['Date'] - first_dt) / pd.Timedelta(days=1)).astype(int).to_numpy()
+    shape = (len(clinics), day_codes.max() + 1)
+    matrix = partial(create_clinic_matrix, rolling_df, clinic_codes=clinic_codes, day_codes=day_codes, shape=shape)
+
+    aged = matrix('# Aged', fill='zero')
+    seen = matrix('# Seen in 30d', fill='zero')
+    rate = matrix('Moving 28d % Seen in 30d', fill='last')
+    window_aged = matrix('Moving 28d # Aged', fill='last')
+
+    # The baseline is the 364d rate as it stood before the 28 days that are compared with it
+    baseline = np.full(shape, np.nan)
+    baseline[:, 28:] = matrix('Moving 364d % Seen in 30d', fill='last')[:, :-28]
+    variance = baseline * (1.0 - baseline)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where((variance > 0) & (window_aged >= min_aged),
+                     (rate - baseline) / np.sqrt(variance / window_aged), np.nan)
+        residual = np.where((variance > 0) & (aged > 0),
+                            (seen - aged * baseline) / np.sqrt(aged * variance), 0.0)
+    if cutoff_dt is not None:
+        is_incomplete = first_dt + pd.to_timedelta(np.arange(shape[1]), unit='D') > pd.Timestamp(cutoff_dt)
+        z[:, is_incomplete] = np.nan
+        residual[:, is_incomplete] = 0.0
+    is_low = z <= -z_threshold
+    is_drop = is_low & ~np.pad(is_low, ((0, 0), (1, 0)))[:, :-1]
+
+    # The CUSUM is a running sum, so it steps through the dates with every clinic updated at once
+    cusum = np.zeros(shape[0])
+    shift_scores = np.zeros(shape)
+    for day in range(shape[1]):
+        cusum = np.maximum(0.0, cusum - residual[:, day] - cusum_slack)
+        is_shift = cusum > cusum_threshold
+        shift_scores[is_shift, day] = cusum[is_shift]
+        cusum[is_shift] = 0.0
+
+    flag_dfs = []
+    for kind, flags, scores in [('Drop', is_drop, z), ('Shift', shift_scores > 0, -shift_scores)]:
+        clinic_idx, day_idx = np.nonzero(flags)
+        flag_dfs.append(pd.DataFrame({
+            'Clinic': clinics.to_numpy(dtype=object)[clinic_idx],
+            'Date': first_dt + pd.to_timedelta(day_idx, unit='D'),
+            'Kind': kind,
+            'Score': np.round(scores[clinic_idx, day_idx], 2),
+            'Moving 28d % Seen in 30d': rate[clinic_idx, day_idx]}))
+    return pd.concat(flag_dfs, ignore_index=True).sort_values(['Clinic', 'Date'], ignore_index=True)
+# END calculate_rate_anomalies
+
+
+def get_complete_measures_date(end_dt: datetime) -> datetime:
+    """Returns the last measurement date up to the given date whose referrals have all had 30 days to be seen."""
+    return min(pd.Timestamp(end_dt), pd.Timestamp(AS_OF_DATE))
+
+
+def rank_flagged_clinics(flag_df: pd.DataFrame, end_dt: datetime, recent_days: int = 91) -> pd.DataFrame:
+    """
+    Returns the clinics with flags in the most recent days of the measures up to the given end date, ranked by the
+    number of recent flags and then by the lowest score among them.
+    """
+    recent_df = flag_df.loc[(flag_df['Date'] > pd.Timestamp(end_dt) - pd.Timedelta(days=recent_days))
+                            & (flag_df['Date'] <= pd.Timestamp(end_dt))]
+    if recent_df.empty:
+        return pd.DataFrame({'Clinic': [], '# Flags': [], 'Lowest Score': [], 'Last Flag': []})
+    return (
+        recent_df.groupby('Clinic')
+        .agg(**{'# Flags': ('Date', 'size'), 'Lowest Score': ('Score', 'min'), 'Last Flag': ('Date', 'max')})
+        .reset_index()
+        .sort_values(['# Flags', 'Lowest Score'], ascending=[False, True], ignore_index=True))
+# END rank_flagged_clinics
+
+
+class ReferralSource:
+    """Base class used to identify sources of referral data that return daily counts of referrals by clinic."""
+    def load_daily_counts(self) -> pd.DataFrame:
+        pass
+
+    def load_referral_offsets(self) -> tuple[pd.DataFrame, pd.Index, datetime]:
+        pass
+
+
+class CsvReferralSource(ReferralSource):
+    """
+    Loads the whole referral extract from a text file and counts the referrals by clinic and date with Pandas. The
+    day offsets of the as-of snapshots are calculated from the same parsed extract and kept with the source.
+
+    Methods:
+        load_daily_counts - Returns a DataFrame of daily referral counts by clinic
+        load_referral_offsets - Returns the per-referral day offsets that as-of snapshots are counted from
+    """
+
+    def __init__(self, file_path: str = DATA_FILE) -> None:
+        self.file_path = file_path
+        self.offsets = None
+
+    def load_daily_counts(self) -> pd.DataFrame:
+        """Returns a DataFrame of daily referral counts by clinic as returned by calculate_daily_counts."""
+        print('loading referral data...')
+        with stage_timer('load_data') as stage:
+            referral_df = load_data(self.file_path, COLUMN_TYPES, DATE_COLUMNS)
+            stage.rows = len(referral_df)
+        print('processing record transforms...')
+        with stage_timer('process_record_transforms') as stage:
+            process_record_transforms(referral_df)
+            stage.rows = len(referral_df)
+        print('counting referrals by date...')
+        with stage_timer('calculate_daily_counts') as stage:
+            count_df = calculate_daily_counts(referral_df)
+            stage.rows = len(count_df)
+        print('calculating referral offsets for snapshots...')
+        with stage_timer('calculate_referral_offsets') as stage:
+            self.offsets = calculate_referral_offsets(referral_df)
+            stage.rows = len(self.offsets[0])
+        return count_df
+
+    def load_referral_offsets(self) -> tuple[pd.DataFrame, pd.Index, datetime]:
+        """Returns the per-referral day offsets as returned by calculate_referral_offsets."""
+        if self.offsets is None:
+            self.load_daily_counts()
+        return self.offsets
+# END CLASS CsvReferralSource
+
+
+# Counts referrals by clinic and the date each reached 30 days of age, with the same rules as process_record_transforms
+# and calculate_daily_counts. Written for SQLite; other databases need their own date arithmetic.
+DAILY_COUNTS_SQL = """
+    WITH measured AS (
+        SELECT "Clinic",
+               date("Date Referral Sent", '+31 days') AS "Date",
+               CASE WHEN COALESCE("Referral Status", '') NOT IN ('Rejected', 'Cancelled')
+                         AND (COALESCE("Referral Status", '') NOT IN ('Closed', 'Completed')
+                              OR COALESCE("Date Referral Seen", "Date Patient Checked In") IS NOT NULL)
+                    THEN 1 ELSE 0 END AS aged,
+               julianday(COALESCE("Date Referral Seen", "Date Patient Checked In"))
+                   - julianday("Date Referral Sent") AS days_until_seen
+        FROM {table}
+        WHERE "Date Referral Sent" IS NOT NULL {where})
+    SELECT "Clinic",
+           "Date",
+           SUM(aged) AS "# Aged",
+           SUM(CASE WHEN aged = 1 AND days_until_seen < 31 THEN 1 ELSE 0 END) AS "# Seen in 30d"
+    FROM measured
+    GROUP BY "Clinic", "Date"
+"""
+
+# Reads only the columns of each referral that process_record_transforms needs to calculate the snapshot offsets
+REFERRAL_OFFSETS_SQL = """
+    SELECT "Clinic", "Referral Status", "Date Referral Sent", "Date Referral Seen", "Date Patient Checked In"
+    FROM {table}
+    WHERE "Date Referral Sent" IS NOT NULL
+"""
+
+# Limits the counts to the measurement dates of referrals that were updated after a watermark
+CHANGED_DATES_SQL = """
+    AND date("Date Referral Sent", '+31 days') IN (
+        SELECT date("Date Referral Sent", '+31 days')
+        FROM {table}
+        WHERE "Date Last Referral Update" > :watermark AND "Date Referral Sent" IS NOT NULL)
+"""
+
+
+class SqlReferralSource(ReferralSource):
+    """
+    Pushes the record transforms and the daily counting of referrals into one GROUP BY query, so that only the small
+    table of counts by clinic and date is read from the database. The table has the columns of the referral extract.
+
+    Methods:
+        load_daily_counts - Returns a DataFrame of daily referral counts by clinic
+        load_changed_counts - Returns the daily counts on the dates of referrals updated after a watermark
+        load_referral_offsets - Returns the per-referral day offsets that as-of snapshots are counted from
+    """
+
+    def __init__(self, connect, table: str = 'referrals') -> None:
+        """
+        Creates a source of referral counts from a database table.
+        :param connect: A function that returns a new DB-API connection to the database
+        :param table: The name of the table of referral data
+        """
+        self.connect = connect
+        self.table = table
+
+    def _read_counts(self, where: str = '', params: dict = None) -> pd.DataFrame:
+        """Returns the result of the daily counts query with an optional filter of the referrals that are counted."""
+        sql = DAILY_COUNTS_SQL.format(table=self.table, where=where.format(table=self.table))
+        connection = self.connect()
+        try:
+            count_df = pd.read_sql_query(sql, connection, params=params or {})
+        finally:
+            connection.close()
+        count_df['Clinic'] = count_df['Clinic'].astype('string')
+        count_df['Date'] = pd.to_datetime(count_df['Date'])
+        return count_df
+
+    def load_daily_counts(self) -> pd.DataFrame:
+        """Returns a DataFrame of daily referral counts by clinic as returned by calculate_daily_counts."""
+        print('counting referrals by date in the database...')
+        with stage_timer('load_daily_counts') as stage:
+            count_df = self._read_counts()
+            stage.rows = len(count_df)
+        return count_df
+
+    def load_changed_counts(self, watermark: datetime) -> tuple[pd.DataFrame, datetime]:
+        """
+        Returns the daily counts of every clinic on the measurement dates of referrals that were updated after the
+        given watermark, along with the latest update time to use as the next watermark. The counts replace the counts
+        on those dates with merge_daily_counts. A referral whose sent date changed leaves its old date uncounted until
+        that date is recounted.
+        """
+        params = {'watermark': watermark.strftime('%Y-%m-%d %H:%M:%S')}
+        connection = self.connect()
+        try:
+            latest = connection.execute(
+                f'SELECT MAX("Date Last Referral Update") FROM {self.table} '
+                f'WHERE "Date Last Referral Update" > :watermark', params).fetchone()[0]
+        finally:
+            connection.close()
+        if latest is None:
+            return self._read_counts('AND 0 = 1'), watermark
+        return self._read_counts(CHANGED_DATES_SQL, params), pd.Timestamp(latest).to_pydatetime()
+
+    def load_referral_offsets(self) -> tuple[pd.DataFrame, pd.Index, datetime]:
+        """Returns the per-referral day offsets as returned by calculate_referral_offsets."""
+        print('reading referral dates for snapshots from the database...')
+        with stage_timer('load_referral_offsets') as stage:
+            connection = self.connect()
+            try:
+                referral_df = pd.read_sql_query(REFERRAL_OFFSETS_SQL.format(table=self.table), connection)
+            finally:
+                connection.close()
+            referral_df['Clinic'] = referral_df['Clinic'].astype('string')
+            referral_df['Referral Status'] = referral_df['Referral Status'].astype('string')
+            date_columns = ['Date Referral Sent', 'Date Referral Seen', 'Date Patient Checked In']
+            referral_df[date_columns] = referral_df[date_columns].apply(pd.to_datetime)
+            process_record_transforms(referral_df)
+            offsets = calculate_referral_offsets(referral_df)
+            stage.rows = len(offsets[0])
+        return offsets
+# END CLASS SqlReferralSource
+
+
+def merge_daily_counts(count_df: pd.DataFrame, changed_df: pd.DataFrame) -> pd.DataFrame:
+    """Returns the daily counts with the counts on each date in the changed counts replaced by the changed counts."""
+    kept_df = count_df.loc[~count_df['Date'].isin(changed_df['Date'])]
+    return pd.concat([kept_df, changed_df], ignore_index=True).sort_values(['Clinic', 'Date'], ignore_index=True)
+# END merge_daily_counts
+
+
+def write_sqlite_database(csv_path: str, db_path: str, table: str = 'referrals') -> None:
+    """Copies a referral extract from a text file into a table of a local SQLite database for testing."""
+    df = load_data(csv_path, COLUMN_TYPES, DATE_COLUMNS)
+    with closing(sqlite3.connect(db_path)) as connection:
+        df.to_sql(table, connection, if_exists='replace', index=False)
+        connection.execute(f'CREATE INDEX IF NOT EXISTS "{table} Last Update" ON {table} ("Date Last Referral Update")')
+        connection.commit()
+# END write_sqlite_database
+
+
+def create_referral_source(file_path: str = DATA_FILE) -> ReferralSource:
+    """Returns a source of referral data for a referral extract or for a SQLite database file."""
+    if file_path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return SqlReferralSource(partial(sqlite3.connect, file_path))
+    return CsvReferralSource(file_path)
+# END create_referral_source
+
+
+# The cached functions below are called with every argument given, because a cache keys a call that leaves out a
+# default argument apart from a call that passes the same value
+@cache
+def get_holidays(file_path: str) -> pd.DatetimeIndex:
+    """Returns the holidays of the business-day calendar, or None without a file when measures follow calendar days."""
+    if file_path is None:
+        return None
+    print('loading holidays...')
+    return load_holidays(file_path)
+
+
+@cache
+def get_referral_source(file_path: str) -> ReferralSource:
+    """Returns the source of the given referral data, created once per server process so that it keeps what it loads."""
+    return create_referral_source(file_path)
+
+
+@cache
+def get_rolling_measures(file_path: str) -> tuple[pd.DataFrame, datetime, datetime]:
+    """
+    Returns the rolling measures and trend fits calculated from the given referral extract or SQLite database along
+    with the first and last measurement dates. The result is calculated once per server process and shared by every
+    session.
+    """
+    count_df = get_referral_source(file_path).load_daily_counts()
+    start_dt, end_dt = count_df['Date'].min(), count_df['Date'].max()
+    print('calculating rolling measures...')
+    with stage_timer('calculate_rolling_measures') as stage:
+        rolling_df = calculate_rolling_measures_from_counts(count_df, start_dt, end_dt, get_holidays(HOLIDAYS_FILE))
+        stage.rows = len(rolling_df)
+    print('calculating trend fits...')
+    with stage_timer('calculate_trend_fits') as stage:
+        rolling_df = calculate_trend_fits(rolling_df)
+        stage.rows = len(rolling_df)
+    return rolling_df, start_dt, end_dt
+# END get_rolling_measures
+
+
+@cache
+def get_data_version(file_path: str) -> str:
+    """Returns a short hash of the rolling measures that changes whenever the calculated measures change."""
+    rolling_df, start_dt, end_dt = get_rolling_measures(file_path)
+    row_hashes = pd.util.hash_pandas_object(rolling_df, index=False).to_numpy()
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()[:16]
+# END get_data_version
+
+
+@cache
+def get_resolution_pyramid(file_path: str) -> dict[str, pd.DataFrame]:
+    """Returns the rolling measures at each resolution, calculated once per server process for every session."""
+    rolling_df, start_dt, end_dt = get_rolling_measures(file_path)
+    print('calculating weekly and monthly rollups...')
+    with stage_timer('calculate_resolution_pyramid') as stage:
+        pyramid = calculate_resolution_pyramid(rolling_df)
+        stage.rows = sum(len(level_df) for level_df in pyramid.values())
+    return pyramid
+# END get_resolution_pyramid
+
+
+@cache
+def get_referral_offsets(file_path: str) -> tuple[pd.DataFrame, pd.Index, datetime]:
+    """Returns the per-referral day offsets of the given referral data, loaded once per server process."""
+    return get_referral_source(file_path).load_referral_offsets()
+
+
+@lru_cache(maxsize=SNAPSHOT_CACHE_SIZE)
+def get_snapshot_pyramid(snapshot_dt: datetime, file_path: str) -> dict[str, pd.DataFrame]:
+    """
+    Returns the rolling measures at each resolution as they would have been calculated on the given date. The
+    snapshots of the most recently used dates are kept so that stepping between them does not count them again.
+    """
+    offset_df, clinics, first_dt = get_referral_offsets(file_path)
+    print(f'calculating rolling measures as of {snapshot_dt:%Y-%m-%d}...')
+    with stage_timer('calculate_snapshot') as stage:
+        count_df = calculate_snapshot_counts(offset_df, clinics, first_dt, snapshot_dt)
+        if count_df.empty:
+            raise ValueError(f'No referrals reached 30 days of age by {snapshot_dt:%Y-%m-%d}')
+        rolling_df = calculate_rolling_measures_from_counts(count_df, count_df['Date'].min(), count_df['Date'].max(),
+                                                            get_holidays(HOLIDAYS_FILE))
+        rolling_df = calculate_trend_fits(rolling_df)
+        pyramid = calculate_resolution_pyramid(rolling_df)
+        stage.rows = len(rolling_df)
+    return pyramid
+# END get_snapshot_pyramid
+
+
+@cache
+def get_rate_anomalies(file_path: str) -> pd.DataFrame:
+    """Returns the drop and shift flags of every clinic's moving rates, calculated once per server process."""
+    rolling_df, start_dt, end_dt = get_rolling_measures(file_path)
+    print('flagging drops in moving rates...')
+    with stage_timer('calculate_rate_anomalies') as stage:
+        flag_df = calculate_rate_anomalies(rolling_df, get_complete_measures_date(end_dt))
+        stage.rows = len(flag_df)
+    return flag_df
+# END get_rate_anomalies
+
+
+@lru_cache(maxsize=SNAPSHOT_CACHE_SIZE)
+def get_snapshot_anomalies(snapshot_dt: datetime, file_path: str) -> pd.DataFrame:
+    """Returns the drop and shift flags of every clinic's moving rates as they would have been flagged on a date."""
+    rolling_df = get_snapshot_pyramid(snapshot_dt, file_path)['Daily']
+    with stage_timer('calculate_snapshot_anomalies') as stage:
+        flag_df = calculate_rate_anomalies(rolling_df, get_complete_measures_date(snapshot_dt))
+        stage.rows = len(flag_df)
+    return flag_df
+# END get_snapshot_anomalies
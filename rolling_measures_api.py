@@ -0,0 +1,143 @@
+"""
+A read-only HTTP endpoint that serves the rolling measures of the moving process rates application as JSON or in the
+Arrow IPC stream format. The endpoint is added to the same Tornado server that runs the Bokeh application.
+
+GET /rolling-measures?clinic=*ALL*&start=2022-01-01&end=2022-12-31&windows=91,364&format=json
+
+Responses carry an ETag derived from the version of the rolling measures. Clients that send the ETag back in an
+If-None-Match header receive a 304 response without a body until the data changes.
+"""
+
+import hashlib
+import io
+
+from functools import cache, lru_cache
+
+import pandas as pd
+
+from tornado.web import HTTPError, RequestHandler
+
+from referral_data import DATA_FILE, get_data_version, get_rolling_measures
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+WINDOW_DAYS = [28, 91, 182, 364]
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+@cache
+def get_clinic_rows(file_path: str) -> dict[str, list[int]]:
+    """Returns the row positions of each clinic in the rolling measures, so that a request slices rows directly."""
+    rolling_df, start_dt, end_dt = get_rolling_measures(file_path)
+    return {clinic: rows for clinic, rows in rolling_df.groupby('Clinic').indices.items()}
+# END get_clinic_rows
+
+
+def select_rolling_measures(clinic: str,
+                            start: str,
+                            end: str,
+                            windows: tuple[int, ...],
+                            file_path: str = DATA_FILE) -> pd.DataFrame:
+    """Returns the daily counts and the rolling measures of the given windows for one clinic and range of dates."""
+    rolling_df, start_dt, end_dt = get_rolling_measures(file_path)
+    rows = get_clinic_rows(file_path)[clinic]
+
+    columns = ['Clinic', 'Date', '# Aged', '# Seen in 30d']
+    for days in windows:
+        columns += [f'Moving {days}d # Aged', f'Moving {days}d # Seen in 30d', f'Moving {days}d % Seen in 30d']
+    data_df = rolling_df.iloc[rows][columns]
+
+    if start is not None:
+        data_df = data_df.loc[data_df['Date'] >= pd.Timestamp(start)]
+    if end is not None:
+        data_df = data_df.loc[data_df['Date'] <= pd.Timestamp(end)]
+    return data_df
+# END select_rolling_measures
+
+
+@lru_cache(maxsize=256)
+def serialize_rolling_measures(version: str,
+                               clinic: str,
+                               start: str,
+                               end: str,
+                               windows: tuple[int, ...],
+                               output_format: str) -> bytes:
+    """
+    Returns a serialized response body of rolling measures. The data version is part of the cache key so that cached
+    bodies are never served for measures that have since been recalculated.
+    """
+    data_df = select_rolling_measures(clinic, start, end, windows)
+    if output_format == 'arrow':
+        table = pyarrow.Table.from_pandas(data_df, preserve_index=False)
+        sink = io.BytesIO()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+    return data_df.to_json(orient='records', date_format='iso').encode('utf-8')
+# END serialize_rolling_measures
+
+
+class RollingMeasuresHandler(RequestHandler):
+    """
+    Tornado request handler for the rolling measures endpoint. Query arguments select the clinic, the first and last
+    dates, the window sizes in days, and the output format.
+    """
+
+    def _get_windows(self) -> tuple[int, ...]:
+        """Returns the window sizes from the windows query argument, or every window size if it is not given."""
+        arg = self.get_argument('windows', None)
+        if arg is None:
+            return tuple(WINDOW_DAYS)
+        try:
+            windows = tuple(sorted({int(w.strip().rstrip('d')) for w in arg.split(',') if w.strip()}))
+        except ValueError:
+            raise HTTPError(400, reason=f'Invalid windows {arg}')
+        if not windows or any(w not in WINDOW_DAYS for w in windows):
+            raise HTTPError(400, reason=f'Windows must be among {WINDOW_DAYS}')
+        return windows
+
+    def _get_date(self, name: str) -> str:
+        """Returns the given date query argument normalized to ISO format, or None if it is not given."""
+        arg = self.get_argument(name, None)
+        if arg is None:
+            return None
+        try:
+            return pd.Timestamp(arg).strftime('%Y-%m-%d')
+        except ValueError:
+            raise HTTPError(400, reason=f'Invalid {name} date {arg}')
+
+    def get(self) -> None:
+        clinic = self.get_argument('clinic', '*ALL*')
+        if clinic not in get_clinic_rows(DATA_FILE):
+            raise HTTPError(404, reason=f'Unknown clinic {clinic}')
+        start = self._get_date('start')
+        end = self._get_date('end')
+        windows = self._get_windows()
+        output_format = self.get_argument('format', 'json')
+        if output_format not in CONTENT_TYPES:
+            raise HTTPError(400, reason=f'Format must be one of {list(CONTENT_TYPES)}')
+        if output_format == 'arrow' and pyarrow is None:
+            raise HTTPError(501, reason='The Arrow format requires the pyarrow package')
+
+        # The ETag only depends on the data version and the query, so it is known without serializing anything
+        version = get_data_version(DATA_FILE)
+        query = f'{clinic}|{start}|{end}|{windows}|{output_format}'
+        etag = f'"{version}-{hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]}"'
+        self.set_header('ETag', etag)
+        self.set_header('Cache-Control', 'no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.set_header('Content-Type', CONTENT_TYPES[output_format])
+        self.write(serialize_rolling_measures(version, clinic, start, end, windows, output_format))
+    # END get
+# END CLASS RollingMeasuresHandler
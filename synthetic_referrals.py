@@ -0,0 +1,151 @@
+"""
+Creates a file of synthetic referral data with the same columns and types as the referral extract, so that the
+application and its benchmarks can be run without real data.
+
+usage: python synthetic_referrals.py [--referrals 100000] [--clinics 50] [--start 2019-01-01] [--end 2023-03-01]
+                                     [--status-mix Seen=0.6,Scheduled=0.1,...] [--delay-shape 2] [--delay-scale 15]
+                                     [--checkin-share 0.3] [--seed 0] [--output referrals.csv]
+"""
+
+import argparse
+
+import numpy as np
+
+import pandas as pd
+
+from datetime import datetime
+
+from referral_data import AS_OF_DATE, COLUMN_TYPES, DATA_FILE
+
+
+STATUS_MIX = {
+    'Seen': 0.55,
+    'Completed': 0.10,
+    'Scheduled': 0.08,
+    'Accepted': 0.07,
+    'Pending Reschedule': 0.03,
+    'Cancelled': 0.07,
+    'Rejected': 0.05,
+    'Closed': 0.05}
+
+# Statuses of referrals that were seen, either tagged as seen or with the patient checked in to an appointment
+SEEN_STATUSES = ['Seen', 'Completed']
+
+
+def create_synthetic_referrals(num_referrals: int = 100000,
+                               num_clinics: int = 50,
+                               start_dt: datetime = datetime(2019, 1, 1),
+                               end_dt: datetime = AS_OF_DATE,
+                               status_mix: dict[str, float] = None,
+                               delay_shape: float = 2.0,
+                               delay_scale: float = 15.0,
+                               checkin_share: float = 0.3,
+                               seed: int = 0) -> pd.DataFrame:
+    """
+    Returns a DataFrame of synthetic referrals with the columns of the referral extract.
+    :param num_referrals: The number of referrals
+    :param num_clinics: The number of clinics that referrals are sent to
+    :param start_dt: The first date that referrals are sent
+    :param end_dt: The last date that referrals are sent, and the last date that referrals are seen
+    :param status_mix: The share of referrals in each referral status
+    :param delay_shape: The shape of the gamma distribution of days from sent until seen
+    :param delay_scale: The scale of the gamma distribution of days from sent until seen
+    :param checkin_share: The share of seen referrals recorded only by a patient check-in
+    :param seed: The seed of the random number generator
+    :return: A DataFrame of referral data as read from the referral extract
+    """
+    rng = np.random.default_rng(seed)
+    status_mix = status_mix or STATUS_MIX
+    statuses = list(status_mix)
+    weights = np.array([status_mix[s] for s in statuses], dtype=float)
+
+    # Clinics receive different volumes of referrals, as the larger specialties do
+    clinics = np.array([f'Clinic {i + 1:03d}' for i in range(num_clinics)])
+    clinic_weights = rng.pareto(1.5, num_clinics) + 1.0
+    clinic_codes = rng.choice(num_clinics, size=num_referrals, p=clinic_weights / clinic_weights.sum())
+    status_codes = rng.choice(len(statuses), size=num_referrals, p=weights / weights.sum())
+    status = np.array(statuses, dtype=object)[status_codes]
+
+    span_days = (pd.Timestamp(end_dt) - pd.Timestamp(start_dt)).days + 1
+    sent = pd.Series(pd.Timestamp(start_dt) + pd.to_timedelta(rng.integers(0, span_days, num_referrals), unit='D'))
+    seen = sent + pd.to_timedelta(np.round(rng.gamma(delay_shape, delay_scale, num_referrals)), unit='D')
+
+    # Referrals that would be seen after the end date are still waiting for an appointment
+    is_seen = np.isin(status, SEEN_STATUSES)
+    is_late = is_seen & (seen > pd.Timestamp(end_dt)).to_numpy()
+    status[is_late] = 'Scheduled'
+    is_seen &= ~is_late
+    is_checkin = is_seen & (rng.random(num_referrals) < checkin_share)
+
+    df = pd.DataFrame({c: pd.Series(pd.NA, index=range(num_referrals), dtype='string')
+                       for c, t in COLUMN_TYPES.items() if t == 'string'})
+    df['Referral ID'] = pd.Series(np.arange(1, num_referrals + 1)).astype('string')
+    df['Patient ID'] = pd.Series(rng.integers(1, max(num_referrals // 2, 2), num_referrals)).astype('string')
+    df['Clinic'] = clinics[clinic_codes]
+    df['Location Referred To'] = df['Clinic']
+    df['Referral Status'] = status
+    df['Referral Priority'] = np.where(rng.random(num_referrals) < 0.1, 'Urgent', 'Routine')
+
+    no_date = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    for c, t in COLUMN_TYPES.items():
+        if t != 'string':
+            df[c] = no_date
+    df['Date Referral Written'] = sent - pd.to_timedelta(rng.integers(0, 3, num_referrals), unit='D')
+    df['Date Referral Sent'] = sent
+    df['Date Referral Seen'] = no_date.where(~(is_seen & ~is_checkin), seen)
+    df['Date Patient Checked In'] = no_date.where(~is_checkin, seen)
+    df['Date Last Referral Update'] = df['Date Referral Seen'].fillna(df['Date Patient Checked In']).fillna(sent)
+    return df[list(COLUMN_TYPES)]
+# END create_synthetic_referrals
+
+
+def write_synthetic_referrals(file_path: str, **kwargs) -> pd.DataFrame:
+    """Writes a file of synthetic referral data that can be read by load_data and returns the data."""
+    df = create_synthetic_referrals(**kwargs)
+    df.to_csv(file_path, index=False, date_format='%Y-%m-%d')
+    return df
+# END write_synthetic_referrals
+
+
+def parse_status_mix(arg: str) -> dict[str, float]:
+    """Returns a status mix from a comma separated list of status=share pairs."""
+    status_mix = {}
+    for pair in arg.split(','):
+        status, share = pair.split('=')
+        status_mix[status.strip()] = float(share)
+    return status_mix
+# END parse_status_mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Create a file of synthetic referral data.')
+    parser.add_argument('--referrals', type=int, default=100000, help='number of referrals')
+    parser.add_argument('--clinics', type=int, default=50, help='number of clinics')
+    parser.add_argument('--start', default='2019-01-01', help='first date referrals are sent')
+    parser.add_argument('--end', default=AS_OF_DATE.strftime('%Y-%m-%d'), help='last date referrals are sent')
+    parser.add_argument('--status-mix', type=parse_status_mix, default=None,
+                        help='share of referrals in each status, e.g. Seen=0.7,Cancelled=0.2,Closed=0.1')
+    parser.add_argument('--delay-shape', type=float, default=2.0, help='gamma shape of days until seen')
+    parser.add_argument('--delay-scale', type=float, default=15.0, help='gamma scale of days until seen')
+    parser.add_argument('--checkin-share', type=float, default=0.3,
+                        help='share of seen referrals recorded only by a patient check-in')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', default=DATA_FILE, help='file to write')
+    args = parser.parse_args()
+
+    df = write_synthetic_referrals(args.output,
+                                   num_referrals=args.referrals,
+                                   num_clinics=args.clinics,
+                                   start_dt=datetime.fromisoformat(args.start),
+                                   end_dt=datetime.fromisoformat(args.end),
+                                   status_mix=args.status_mix,
+                                   delay_shape=args.delay_shape,
+                                   delay_scale=args.delay_scale,
+                                   checkin_share=args.checkin_share,
+                                   seed=args.seed)
+    print(f'wrote {len(df)} referrals to {args.output}')
+# END main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Keeps the prepared column data of each plot for the views of the moving process rates application in a cache that is
+shared by every session started by the same server process. A view is a clinic at one resolution of the measures,
+either as of the latest data or as of a past snapshot date. Sessions that open on a popular view are served from the
+cache without slicing the rolling measures again.
+"""
+
+from functools import lru_cache
+
+import pandas as pd
+
+from datetime import datetime
+
+from numpy import ndarray
+
+from referral_data import DATA_FILE, get_resolution_pyramid, get_rolling_measures, get_snapshot_pyramid
+from clinic_plots import ClinicPlot, DailyVolumesPlot, MovingVolumesPlot, MovingRatesPlot
+from pipeline_metrics import stage_timer
+
+
+VIEW_CACHE_SIZE = 1024
+
+PLOT_CLASSES = [MovingRatesPlot, MovingVolumesPlot, DailyVolumesPlot]
+
+
+@lru_cache(maxsize=VIEW_CACHE_SIZE)
+def get_view_data(plot_class: type[ClinicPlot],
+                  clinic: str,
+                  level: str,
+                  snapshot_dt: datetime) -> dict[str, ndarray]:
+    """
+    Returns the column data of a plot for one clinic as a dictionary of arrays that can be assigned to the plot's
+    ColumnDataSource. Bokeh copies the dictionary on assignment, so the cached arrays are shared and never changed.
+    :param plot_class: The class of the plot whose dataset is prepared
+    :param clinic: The clinic name
+    :param level: The resolution of the measures
+    :param snapshot_dt: The as-of snapshot date of the measures, or None for the latest measures
+    :return: A dictionary of the columns of the plot's dataset
+    """
+    if snapshot_dt is None:
+        pyramid = get_resolution_pyramid(DATA_FILE)
+    else:
+        pyramid = get_snapshot_pyramid(snapshot_dt, DATA_FILE)
+    data_df = plot_class.create_dataset(pyramid[level], clinic)
+    return {c: v.to_numpy() for c, v in data_df.items()}
+# END get_view_data
+
+
+def get_busiest_clinics(num_clinics: int, file_path: str = DATA_FILE) -> list[str]:
+    """Returns the clinics with the most referrals in the latest year of measures, starting with every clinic."""
+    rolling_df, start_dt, end_dt = get_rolling_measures(file_path)
+    recent_df = rolling_df.loc[rolling_df['Date'] > pd.Timestamp(end_dt) - pd.Timedelta(days=364)]
+    volumes = recent_df.groupby('Clinic')['# Aged'].sum().drop('*ALL*', errors='ignore')
+    return ['*ALL*'] + volumes.sort_values(ascending=False).index[:num_clinics].tolist()
+# END get_busiest_clinics
+
+
+def prewarm_view_cache(num_clinics: int = 20) -> None:
+    """Prepares the latest daily views of every clinic and of the busiest clinics before the first session opens."""
+    clinics = get_busiest_clinics(num_clinics)
+    print(f'preparing views of {len(clinics)} clinics...')
+    with stage_timer('prewarm_view_cache') as stage:
+        for clinic in clinics:
+            for plot_class in PLOT_CLASSES:
+                get_view_data(plot_class, clinic, 'Daily', None)
+        stage.rows = len(clinics) * len(PLOT_CLASSES)
+# END prewarm_view_cache